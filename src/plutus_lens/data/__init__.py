@@ -6,5 +6,13 @@ Created on Sat Nov 23 12:11:13 2024
 """
 
 
-from .database_studio import CollectionConnect
+import os
+
+DB_BACKEND = os.environ.get('capital_tracker_db_backend', 'mongodb') # 'mongodb' (server) or 'sqlite' (embedded)
+
+if DB_BACKEND == 'sqlite':
+    from .sqlite_studio import SQLiteCollectionConnect as CollectionConnect
+else:
+    from .database_studio import CollectionConnect
+from .database_schema import ensure_collection_indexes, index_usage_report
 from .platform_data._data_extract_util import collection_config
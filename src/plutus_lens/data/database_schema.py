@@ -0,0 +1,109 @@
+''' Declarative registry of the capital_vault collections indexes
+(creation of the missing indexes at startup and index usage reporting) and of the ledger columns dtypes '''
+
+import pandas as pd
+
+
+
+
+DATE_INDEX = [('date', 1)]
+
+COLLECTION_INDEXES = {
+    'cash_flows': [DATE_INDEX, [('platform', 1), ('currency', 1), ('date', 1)], [('currency', 1), ('date', 1)]],
+    'securities_ledger': [DATE_INDEX, [('platform', 1), ('ticker', 1), ('date', 1)], [('platform', 1), ('quote_currency', 1), ('date', 1)],
+                          [('ticker', 1), ('date', 1)], [('quote_currency', 1), ('date', 1)]],
+    'cryptos_ledger': [DATE_INDEX, [('platform', 1), ('ticker', 1), ('date', 1)], [('ticker', 1), ('date', 1)]],
+    'fixed_income_ledger': [DATE_INDEX, [('platform', 1), ('isin', 1), ('date', 1)], [('platform', 1), ('currency', 1), ('date', 1)]],
+    'fx_matrix': [DATE_INDEX],
+    'market_prices': [DATE_INDEX],
+    'fx_matrix_long': [DATE_INDEX, [('ticker', 1), ('date', 1)]],
+    'market_prices_long': [DATE_INDEX, [('ticker', 1), ('date', 1)]],
+}
+
+_ENSURED_COLLECTIONS = set() # (address, database, collection) with every registry index, checked during this process
+
+LEDGER_COLLECTIONS = ['cash_flows', 'securities_ledger', 'cryptos_ledger', 'fixed_income_ledger']
+
+LEDGER_CATEGORY_COLUMNS = ['platform', 'type', 'currency', 'quote_currency', 'asset_class', 'ticker', 'isin']
+LEDGER_FLOAT_COLUMNS = ['amount', 'units', 'price', 'fees', 'balance_by_cat']
+
+
+
+
+def ensure_collection_indexes(collection_connect):
+    ''' Creates the missing registry indexes of a connected collection (checked once per process and collection, once
+    every registry index exists: the SQLite backend can only index the fields already stored, the call is then repeated
+    after the writes).
+
+    Parameters
+    ----------
+    collection_connect : CollectionConnect
+        Connection to the collection, collections absent from the registry are left untouched.
+
+    Returns
+    -------
+    list
+        Names of the indexes created by the call.
+
+    '''
+
+    key = (collection_connect.client_address, collection_connect.database_name, collection_connect.collection_name)
+    index_specs = COLLECTION_INDEXES.get(collection_connect.collection_name)
+    if key in _ENSURED_COLLECTIONS or not index_specs:
+        return []
+
+    created_indexes, skipped_specs = collection_connect.ensure_indexes(index_specs)
+    if not skipped_specs:
+        _ENSURED_COLLECTIONS.add(key)
+    if created_indexes:
+        print(f"\033[1;32m{collection_connect.collection_name} indexes:\033[37m\033[3m created {', '.join(created_indexes)}.\033[0m")
+    return created_indexes
+
+
+def index_usage_report(collection_connects):
+    ''' Gathers the index usage statistics of several connected collections.
+
+    Parameters
+    ----------
+    collection_connects : list
+        List of CollectionConnect objects.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per collection index, with the collection name, index name, keys and number of accesses.
+
+    '''
+
+    usage_list = []
+    for collection_connect in collection_connects:
+        usage = collection_connect.index_usage()
+        usage.insert(0, 'collection', collection_connect.collection_name)
+        usage_list.append(usage)
+    return pd.concat(usage_list, ignore_index=True) if usage_list else pd.DataFrame()
+
+
+def apply_ledger_schema(data, cast_floats=True):
+    ''' Casts the ledger columns of a DataFrame to their canonical dtypes: categoricals for the low cardinality labels
+    (platform, type, currencies, asset class, tickers) and float64 for the numeric columns. Absent columns are skipped.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        Ledger records (extract output or collection query output).
+    cast_floats : bool, optional
+        If False, the numeric columns keep their dtype (the extracts keep them, the _id embeds str() of the amounts).
+        The default is True.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The cast DataFrame (data itself if every column already has its canonical dtype).
+
+    '''
+
+    dtypes = {column: 'category' for column in LEDGER_CATEGORY_COLUMNS}
+    if cast_floats:
+        dtypes.update({column: 'float64' for column in LEDGER_FLOAT_COLUMNS})
+    casts = {column: dtype for column, dtype in dtypes.items() if column in data.columns and data[column].dtype != dtype}
+    return data.astype(casts) if casts else data
@@ -1,8 +1,104 @@
 ''' Functional file related to MongoDB database management
 (Connection to the db, writing and querying of the data) '''
 
+import threading
+from datetime import datetime
+
+import numpy as np
 import pandas as pd
-from pymongo import MongoClient, errors
+from pymongo import IndexModel, MongoClient, InsertOne, UpdateOne, errors
+
+from .database_schema import LEDGER_COLLECTIONS, apply_ledger_schema
+
+try:
+    from pymongoarrow.api import find_numpy_all
+except ImportError: # optional, columnar queries fall back to columnar_decode
+    find_numpy_all = None
+
+
+HASH_FIELD = '_hash' # content hash stored with each document to detect unchanged rows
+
+_CLIENTS = {} # one pooled MongoClient per server address, shared by every connection object
+_DATABASE_NAMES = {} # cached existence checks, keyed by address
+_COLLECTION_NAMES = {} # cached existence checks, keyed by (address, database name)
+_CLIENTS_LOCK = threading.Lock()
+
+
+
+
+def frame_to_documents(data, id_column_name=False):
+    ''' Builds the MongoDB documents of a DataFrame column by column (avoids the per row Series creation of iterrows).
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        Data to be converted into documents.
+    id_column_name : str, optional
+        Name of the column to be copied into the _id field of each document. The default is False (no _id added).
+
+    Returns
+    -------
+    list
+        List of dict, one per row of data, with native python values.
+
+    '''
+
+    columns = {column: data[column].tolist() for column in data.columns}
+    documents = [dict(zip(columns, values)) for values in zip(*columns.values())]
+    if id_column_name:
+        for document in documents:
+            document['_id'] = document[id_column_name]
+    return documents
+
+
+def content_hashes(data):
+    ''' Computes a compact content hash per row of data (vectorized 64 bits hash of all the columns values).
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        Data to be hashed, the HASH_FIELD column is ignored if present.
+
+    Returns
+    -------
+    list
+        One signed 64 bits integer per row (storable as is in MongoDB / SQLite).
+
+    '''
+
+    hashed_data = data.drop(columns=[HASH_FIELD], errors='ignore')
+    return pd.util.hash_pandas_object(hashed_data, index=False).to_numpy().view('int64').tolist()
+
+
+def shared_client(client_address):
+    ''' Returns the MongoClient of the given address, created on first use and then reused by the whole process.
+
+    MongoClient is thread-safe and keeps its own connection pool, so sharing it avoids one handshake per connection object.
+
+    Parameters
+    ----------
+    client_address : str
+        MongoDB server address.
+
+    Returns
+    -------
+    pymongo.MongoClient
+        The pooled client of the address.
+
+    '''
+
+    with _CLIENTS_LOCK:
+        if client_address not in _CLIENTS:
+            _CLIENTS[client_address] = MongoClient(client_address)
+        return _CLIENTS[client_address]
+
+
+def clear_metadata_cache():
+    ''' Forgets the cached database / collection names (they are fetched again by the next connection object). '''
+
+    with _CLIENTS_LOCK:
+        _DATABASE_NAMES.clear()
+        _COLLECTION_NAMES.clear()
 
 
 
@@ -20,8 +116,12 @@ class DataBaseConnect:
     '''
 
     def __init__(self, database_name, client_address='mongodb://localhost:27017/'):
-        self.client = MongoClient(client_address)
-        self.database_list = self.client.list_database_names()
+        self.client_address = client_address
+        self.client = shared_client(client_address)
+        with _CLIENTS_LOCK:
+            if client_address not in _DATABASE_NAMES:
+                _DATABASE_NAMES[client_address] = set(self.client.list_database_names())
+            self.database_list = _DATABASE_NAMES[client_address]
         self.database = self.__database_connect(database_name)
 
 
@@ -43,6 +143,7 @@ class DataBaseConnect:
         if name not in self.database_list:
             creation_confirmation = input('The database does not exist, do you want to create it (True / False): ')
             self.creation_user_choice(creation_confirmation)
+            self.database_list.add(name)
         return self.client[name]
 
 
@@ -78,7 +179,12 @@ class CollectionConnect(DataBaseConnect):
 
     def __init__(self, collection_name, database_name, client_address='mongodb://localhost:27017/'):
         super().__init__(database_name=database_name, client_address=client_address)
-        self.collection_list = self.database.list_collection_names()
+        with _CLIENTS_LOCK:
+            if (client_address, database_name) not in _COLLECTION_NAMES:
+                _COLLECTION_NAMES[(client_address, database_name)] = set(self.database.list_collection_names())
+            self.collection_list = _COLLECTION_NAMES[(client_address, database_name)]
+        self.database_name = database_name
+        self.collection_name = collection_name
         self.collection = self.__collection_connect(collection_name)
 
 
@@ -100,52 +206,333 @@ class CollectionConnect(DataBaseConnect):
         if name not in self.collection_list:
             creation_confirmation = input('The collection does not exist in this database, do you want to create it (True / False): ')
             self.creation_user_choice(creation_confirmation)
+            self.collection_list.add(name)
         return self.database[name]
 
 
-    def collection_writer(self, data, id_column_name=False):
+    def collection_writer(self, data, id_column_name=False, bulk=True, batch_size=1000, skip_unchanged=True):
         ''' Includes the element of data into the MongoDB collection.
 
+        In bulk mode the documents are built straight from the DataFrame columns and sent as unordered batches of upserts
+        (one round trip per batch), otherwise each row is inserted one at a time (and updated on duplicate key).
+
         Parameters
         ----------
         data : pandas.DataFrame
             Data to be included in the MongoDB collection.
         id_column_name : str
             Name of the column that should be considered as MongoDB as the _id (unique identifier) of each document.
+        bulk : bool, optional
+            If True, writes the documents with batched bulk upserts. The default is True.
+        batch_size : int, optional
+            Number of documents sent per bulk request. The default is 1000.
+        skip_unchanged : bool, optional
+            If True, stores a content hash with each document and only sends the documents whose hash differs from the
+            stored one (one hash lookup per batch, in both modes). The default is True.
+
+        Returns
+        -------
+        dict
+            Number of documents inserted, modified or left unchanged by the write.
 
         '''
 
-        for _, row in data.iterrows():
-            mongodb_fields = row.to_dict()
-            if id_column_name:
-                mongodb_fields['_id'] = mongodb_fields[id_column_name]
+        documents = frame_to_documents(data, id_column_name)
+        if skip_unchanged:
+            for document, content_hash in zip(documents, content_hashes(data)):
+                document[HASH_FIELD] = content_hash
+        report = {'inserted': 0, 'modified': 0, 'unchanged': 0}
+        for start in range(0, len(documents), batch_size):
+            batch = documents[start:start + batch_size]
+            if skip_unchanged:
+                batch = self.__changed_documents(batch)
+                report['unchanged'] += min(batch_size, len(documents) - start) - len(batch)
+                if not batch:
+                    continue
+            if not bulk:
+                for key, count in self.__row_writer(batch).items():
+                    report[key] += count
+                continue
+            requests = [UpdateOne({'_id': document['_id']}, {'$set': document}, upsert=True) if '_id' in document else InsertOne(document)
+                        for document in batch]
+            result = self.collection.bulk_write(requests, ordered=False)
+            report['inserted'] += result.inserted_count + result.upserted_count
+            report['modified'] += result.modified_count
+            report['unchanged'] += result.matched_count - result.modified_count
+        return report
+
+
+    def field_updater(self, data, fields, id_column_name='_id', batch_size=1000):
+        ''' Sets some fields of documents already stored ($set of the given fields only, the other fields are left untouched).
+
+        Rows whose fields are all missing are not sent. The stored content hash of the updated documents is removed, it
+        no longer matches their content (their next collection_writer call rewrites them).
+
+        Parameters
+        ----------
+        data : pandas.DataFrame
+            Values of the fields to be set, with the _id of the documents to be updated.
+        fields : list
+            Columns of data to be set.
+        id_column_name : str, optional
+            Name of the column holding the _id of the documents. The default is '_id'.
+        batch_size : int, optional
+            Number of updates sent per bulk request. The default is 1000.
+
+        Returns
+        -------
+        dict
+            Number of documents inserted (always 0), modified or left unchanged by the update.
+
+        '''
+
+        data = data.loc[data[fields].notna().any(axis=1)]
+        documents = frame_to_documents(data[fields])
+        report = {'inserted': 0, 'modified': 0, 'unchanged': 0}
+        for start in range(0, len(documents), batch_size):
+            requests = [UpdateOne({'_id': document_id}, {'$set': document, '$unset': {HASH_FIELD: ''}})
+                        for document_id, document in zip(data[id_column_name].iloc[start:start + batch_size].tolist(), documents[start:start + batch_size])]
+            result = self.collection.bulk_write(requests, ordered=False)
+            report['modified'] += result.modified_count
+            report['unchanged'] += result.matched_count - result.modified_count
+        return report
+
+
+    def __changed_documents(self, documents):
+        ''' Filters out the documents whose content hash is identical to the one already stored (single $in query on _id). '''
+
+        ids = [document['_id'] for document in documents if '_id' in document]
+        stored_hashes = {stored['_id']: stored.get(HASH_FIELD) for stored in self.collection.find({'_id': {'$in': ids}}, {HASH_FIELD: 1})}
+        return [document for document in documents if '_id' not in document or stored_hashes.get(document['_id']) != document[HASH_FIELD]]
+
+
+    def __row_writer(self, documents):
+        ''' Writes the documents one at a time (one insert round trip per document, plus one update on duplicate key). '''
+
+        report = {'inserted': 0, 'modified': 0, 'unchanged': 0}
+        for mongodb_fields in documents:
             try:
                 self.collection.insert_one(mongodb_fields)
+                report['inserted'] += 1
             except errors.DuplicateKeyError:
-                self.collection.update_one({'_id': mongodb_fields['_id']}, {'$set': mongodb_fields}, upsert=True)
+                result = self.collection.update_one({'_id': mongodb_fields['_id']}, {'$set': mongodb_fields}, upsert=True)
+                report['modified'] += result.modified_count
+                report['unchanged'] += result.matched_count - result.modified_count
+        return report
+
 
+    def ensure_indexes(self, index_specs):
+        ''' Creates the indexes of index_specs that do not exist yet on the collection.
 
-    def document_query(self, query_dict):
+        Parameters
+        ----------
+        index_specs : list
+            List of index keys, each one being a list of (field, direction) tuples.
+            ex: [[('date', 1)], [('platform', 1), ('ticker', 1), ('date', 1)]]
+
+        Returns
+        -------
+        created_indexes : list
+            Names of the indexes created by the call.
+        skipped_specs : list
+            Index keys not created, always empty (MongoDB indexes fields before they are stored), kept for the
+            SQLiteCollectionConnect contract.
+
+        '''
+
+        existing_keys = [list(index['key']) for index in self.collection.index_information().values()]
+        missing_specs = [list(keys) for keys in index_specs if list(keys) not in existing_keys]
+        if not missing_specs:
+            return [], []
+        return self.collection.create_indexes([IndexModel(keys) for keys in missing_specs]), []
+
+
+    def index_usage(self):
+        ''' Returns the usage statistics of the collection indexes (number of operations using each index since the server start).
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per index with its name, keys, number of accesses and the date since when they are counted.
+
+        '''
+
+        stats = self.collection.aggregate([{'$indexStats': {}}])
+        usage = [{'name': stat['name'], 'key': list(stat['key'].items()), 'accesses': stat['accesses']['ops'], 'since': stat['accesses']['since']}
+                 for stat in stats]
+        return pd.DataFrame(usage, columns=['name', 'key', 'accesses', 'since'])
+
+
+    def date_bounds(self, date_col='date'):
+        ''' Returns the first and last dates of the collection, read from the date index (two index-sorted lookups
+        instead of a scan of the documents).
+
+        Returns
+        -------
+        tuple
+            (start, end) as pandas.Timestamp, NaT if the collection holds no date.
+
+        '''
+
+        bounds = []
+        for direction in (1, -1):
+            document = self.collection.find_one({date_col: {'$ne': None}}, {date_col: 1, '_id': 0}, sort=[(date_col, direction)])
+            bounds.append(pd.Timestamp(document[date_col]) if document else pd.NaT)
+        return tuple(bounds)
+
+
+    def distinct_values(self, field):
+        ''' Returns the distinct non-missing values of a field, computed server-side (index scan if the field prefixes an index). '''
+
+        return [value for value in self.collection.distinct(field) if value is not None]
+
+
+    def document_delete(self, query_dict=None, date_range=None, equals=None, date_col='date'):
+        ''' Deletes the documents matching the filters (same filters as document_query, no filter deletes every document).
+
+        Returns
+        -------
+        int
+            Number of documents deleted.
+
+        '''
+
+        return self.collection.delete_many(build_query_filter(query_dict, date_range, equals, date_col)).deleted_count
+
+
+    def document_query(self, query_dict=None, projection=None, date_range=None, equals=None, date_col='date', batch_size=None, columnar=False):
         ''' Retrieves document(s) from the collection based on the query dict match
 
         Parameters
         ----------
-        query_dict : dict
+        query_dict : dict, optional
             Dictionnary with the filters that should be applied for the query (key / value in the dict same as in the document).
             ex: {"age": {"$gt": 25}, "city": "New York"}
+        projection : list, optional
+            Fields to be returned by the server (all the fields but the content hash if not specified). _id is only returned if listed.
+        date_range : tuple, optional
+            (start, end) bounds (inclusive, any of them can be None) applied server-side on date_col.
+        equals : dict, optional
+            Field / value equality predicates, a list as value matches any of its elements.
+            ex: {"platform": "Kraken", "ticker": ["ETH-USD", "SOL-USD"]}
+        date_col : str, optional
+            Name of the date field used by date_range. The default is 'date'.
+        batch_size : int, optional
+            Number of documents fetched per cursor round trip (server default if not specified).
+        columnar : bool, optional
+            If True, decodes the output into typed NumPy columns instead of building the DataFrame from the documents.
 
         Returns
         -------
-        dict
-            Query output (elements of the collection for which the filters match.
+        pandas.DataFrame
+            Query output (elements of the collection for which the filters match), with the ledger schema dtypes
+            (categorical labels, float64 amounts) for the ledger collections.
 
         '''
 
-        if query_dict:
-            query_output = self.collection.find(query_dict)
+        query_filter = build_query_filter(query_dict, date_range, equals, date_col)
+        projection_dict = {HASH_FIELD: 0}
+        if projection:
+            projection_dict = {field: 1 for field in projection}
+            projection_dict.setdefault('_id', 0)
+
+        if columnar and find_numpy_all is not None:
+            cursor_kwargs = {'batch_size': batch_size} if batch_size else {}
+            query_df = pd.DataFrame(find_numpy_all(self.collection, query_filter, projection=projection_dict, **cursor_kwargs))
         else:
-            query_output = self.collection.find() # returns the full collection if no filter is specified
-        return pd.DataFrame(query_output)
+            query_output = self.collection.find(query_filter, projection_dict) # returns the full collection if no filter is specified
+            if batch_size:
+                query_output = query_output.batch_size(batch_size)
+            query_df = columnar_decode(query_output, projection) if columnar else pd.DataFrame(query_output)
+        return apply_ledger_schema(query_df) if self.collection_name in LEDGER_COLLECTIONS else query_df
+
+
+
+
+def build_query_filter(query_dict=None, date_range=None, equals=None, date_col='date'):
+    ''' Combines a raw query dict with date range and equality predicates into a single MongoDB filter.
+
+    Parameters
+    ----------
+    query_dict : dict, optional
+        Raw MongoDB filter.
+    date_range : tuple, optional
+        (start, end) inclusive bounds on date_col, any of them can be None.
+    equals : dict, optional
+        Field / value equality predicates, a list as value is translated into an $in predicate.
+    date_col : str, optional
+        Name of the date field used by date_range. The default is 'date'.
+
+    Returns
+    -------
+    dict
+        MongoDB filter.
+
+    '''
+
+    query_filter = dict(query_dict) if query_dict else {}
+    if date_range:
+        start, end = date_range
+        date_filter = {}
+        if start is not None:
+            date_filter['$gte'] = pd.Timestamp(start).to_pydatetime()
+        if end is not None:
+            date_filter['$lte'] = pd.Timestamp(end).to_pydatetime()
+        if date_filter:
+            query_filter[date_col] = date_filter
+    for field, value in (equals or {}).items():
+        query_filter[field] = {'$in': list(value)} if isinstance(value, (list, tuple, set)) else value
+    return query_filter
+
+
+
+def columnar_decode(documents, fields=None):
+    ''' Decodes an iterable of documents into a DataFrame built from typed NumPy columns.
+
+    Values are accumulated field by field, then each column is converted once (datetime64, int64, float64 or object)
+    instead of letting pandas infer the dtypes from a list of dicts.
+
+    Parameters
+    ----------
+    documents : iterable
+        Documents (dict) to decode, typically a pymongo cursor.
+    fields : list, optional
+        Fields to decode, the union of the documents fields (in order of appearance) if not specified.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Decoded documents.
+
+    '''
+
+    columns = {field: [] for field in fields} if fields else {}
+    size = 0
+    for document in documents:
+        if not fields:
+            for field in document:
+                if field not in columns:
+                    columns[field] = [None] * size
+        for field, values in columns.items():
+            values.append(document.get(field))
+        size += 1
+    return pd.DataFrame({field: _typed_column(values) for field, values in columns.items()})
+
+
+def _typed_column(values):
+    ''' Converts a list of decoded values into a NumPy array with a fixed dtype (missing values as NaT / NaN). '''
+
+    sample = next((value for value in values if value is not None), None)
+    if isinstance(sample, datetime):
+        return np.array([value.replace(tzinfo=None) if value is not None else None for value in values], dtype='datetime64[ns]')
+    if isinstance(sample, (int, float)) and not isinstance(sample, bool):
+        if isinstance(sample, int) and all(type(value) is int for value in values):
+            return np.array(values, dtype='int64')
+        try:
+            return np.array(values, dtype='float64')
+        except (TypeError, ValueError):
+            pass
+    return np.array(values, dtype=object)
 
 
 
@@ -0,0 +1,100 @@
+''' Download status of the market tickers (last available price and last request without prices per ticker), stored in
+the capital_vault price_source_status collection and used to stop requesting the delisted tickers at each refresh. '''
+
+import pandas as pd
+
+from src.plutus_lens.data import CollectionConnect
+from src.plutus_lens.data.market_data.price_sources import NO_PRICES
+
+
+DELISTED_AFTER = pd.Timedelta(days=14) # days without any price after the last price of a ticker before it is considered delisted
+DELISTED_RETRY = pd.Timedelta(days=30) # delay before a delisted ticker is requested again
+
+
+
+
+class PriceSourceStatus:
+    ''' Class meant to read / update the download status of the tickers of a market prices collection.
+
+    Each status document (_id '{collection_name} - {ticker}') holds:
+    - last_date: date of the last price returned for the ticker (UTC), None if the price source never returned any.
+    - failed_from: start date (UTC) of the last request that returned no prices, None if the last request returned prices.
+    - failure: error message of that request.
+    - checked_at: time of the last request.
+
+    A ticker is delisted when a request returned no prices (not an error of the price source) more than DELISTED_AFTER
+    after the last price of the ticker (after failed_from for a ticker without any price). The delisted tickers are
+    skipped by the requests starting from failed_from or later, and requested again DELISTED_RETRY after the last check.
+
+    Attributes
+    ----------
+    collection_name : str
+        Name of the market prices collection (ex: 'market_prices').
+    collection : CollectionConnect
+        Connection to the price_source_status collection.
+    status : dict
+        Status documents by ticker.
+    '''
+
+    def __init__(self, collection_name):
+        self.collection_name = collection_name
+        self.collection = CollectionConnect(database_name='capital_vault', collection_name='price_source_status')
+        stored = self.collection.document_query({'collection_name': collection_name})
+        self.status = {} if stored.empty else {document['ticker']: document for document in stored.to_dict('records')}
+
+
+    def last_date(self, ticker):
+        status = self.status.get(ticker)
+        return pd.to_datetime(status['last_date'], utc=True) if status and not pd.isna(status['last_date']) else None
+
+
+    def delisted(self, tickers, start_date):
+        ''' Returns the tickers known to be delisted for a request starting at start_date. '''
+
+        start_date, now = pd.to_datetime(start_date, utc=True), pd.Timestamp.now(tz='UTC')
+        delisted = []
+        for ticker in tickers:
+            status = self.status.get(ticker)
+            if not status or status['failure'] != NO_PRICES or pd.isna(status['failed_from']):
+                continue
+            failed_from, checked_at = pd.to_datetime(status['failed_from'], utc=True), pd.to_datetime(status['checked_at'], utc=True)
+            last_date = self.last_date(ticker)
+            without_prices = checked_at - (failed_from if last_date is None else last_date)
+            if without_prices > DELISTED_AFTER and start_date >= failed_from and now - checked_at < DELISTED_RETRY:
+                delisted.append(ticker)
+        return delisted
+
+
+    def update(self, tickers, start_date, failures, last_dates):
+        ''' Records the outcome of a request.
+
+        Parameters
+        ----------
+        tickers : list
+            Tickers requested.
+        start_date : datetime
+            First date requested.
+        failures : dict
+            Error message per ticker without prices (as returned by get_prices).
+        last_dates : dict
+            Date of the last available price per ticker (PriceSource.last_dates).
+        '''
+
+        start_date, now = pd.to_datetime(start_date, utc=True), pd.Timestamp.now(tz='UTC')
+        documents = []
+        for ticker in tickers:
+            failed = ticker in failures
+            last_date = self.last_date(ticker) if failed or ticker not in last_dates else pd.to_datetime(last_dates[ticker], utc=True)
+            documents.append({
+                '_id': f'{self.collection_name} - {ticker}',
+                'collection_name': self.collection_name,
+                'ticker': ticker,
+                'last_date': last_date,
+                'failed_from': start_date if failed else None,
+                'failure': failures[ticker] if failed else None,
+                'checked_at': now,
+            })
+        if documents:
+            status_df = pd.DataFrame(documents).astype(object)
+            self.collection.collection_writer(status_df.where(status_df.notna(), None), '_id', skip_unchanged=False) # None, not NaT (BSON)
+            self.status.update({document['ticker']: document for document in documents})
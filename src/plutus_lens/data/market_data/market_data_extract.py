@@ -1,12 +1,94 @@
+import os
+
+import numpy as np
 import pandas as pd
-import yfinance as yf
+from src.plutus_lens.data import CollectionConnect, ensure_collection_indexes
+from src.plutus_lens.data.market_data.price_sources import default_price_source
+from src.plutus_lens.data.market_data._price_status import PriceSourceStatus
+from src.plutus_lens.data.market_data.price_store import PriceStore
+
+
+MARKET_STORAGE = os.environ.get('capital_tracker_market_storage', 'wide') # 'wide' (one document per date), 'long' (one per date and ticker) or 'arrow' (local price store)
+
+
+def get_prices(ticks, start_date=None, end_date=None, source=None):
+    ''' Downloads the daily prices of ticks.
+
+    Parameters
+    ----------
+    ticks : list
+        Tickers to be downloaded.
+    start_date : datetime, optional
+        First date of the prices (full history if not specified).
+    end_date : datetime, optional
+        Last date of the prices (exclusive, today if not specified).
+    source : PriceSource, optional
+        Prices provider, default_price_source() if not specified (Yahoo Finance, or the offline files of capital_tracker_price_source_dir).
+
+    Returns
+    -------
+    prices : pandas.DataFrame
+        Prices indexed by Date, one column per ticker with prices (forward filled).
+    failures : dict
+        Error message per ticker without prices, to be requested again by a later refresh.
+    '''
+
+    source = source or default_price_source()
+    prices, failures = source.download(ticks, start_date=start_date, end_date=end_date)
+    if failures:
+        print(f"\033[1;33mPrices download:\033[37m\033[3m no prices for {', '.join(sorted(failures))}.\033[0m")
+    return prices.astype('float32').ffill(), failures
+
+
+
+def melt_prices(wide_df, columns=None):
+    ''' Converts a wide prices df (one row per date, one column per ticker) into (date, ticker, price) records.
+
+    Parameters
+    ----------
+    wide_df : pandas.DataFrame
+        Prices with a date column and one column per ticker (an _id column is ignored).
+    columns : list, optional
+        Tickers to be converted, all the tickers if not specified.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Long prices with the columns _id ('{ticker} - {timestamp}'), date, ticker and price, missing prices are dropped.
+    '''
+
+    columns = columns if columns is not None else [col for col in wide_df.columns if col not in ('_id', 'date')]
+    long_df = wide_df.melt(id_vars='date', value_vars=columns, var_name='ticker', value_name='price').dropna(subset=['price'])
+    epoch_seconds = pd.to_datetime(long_df['date']).to_numpy('datetime64[s]').astype('int64').astype(str)
+    long_df['_id'] = long_df['ticker'].astype(str).to_numpy(dtype=object) + ' - ' + epoch_seconds.astype(object)
+    return long_df[['_id', 'date', 'ticker', 'price']]
+
 
-from src.plutus_lens.data import CollectionConnect
+def pivot_prices(long_df):
+    ''' Converts (date, ticker, price) records into a wide prices df, by scattering the prices into a dates x tickers NumPy matrix.
 
+    Parameters
+    ----------
+    long_df : pandas.DataFrame
+        Long prices with the columns date, ticker and price.
 
-def get_prices(ticks, start_date=None, end_date=None):
-    prices = yf.download(ticks, start=start_date, end=end_date, interval='1d')['Adj Close']
-    return prices.astype('float32').ffill()
+    Returns
+    -------
+    pandas.DataFrame
+        Wide prices with the columns _id (the date, as in the wide storage), date and one column per ticker.
+    '''
+
+    if long_df.empty:
+        return pd.DataFrame()
+    dates, date_idx = np.unique(long_df['date'].to_numpy(), return_inverse=True)
+    tickers, ticker_idx = np.unique(long_df['ticker'].to_numpy(dtype=str), return_inverse=True)
+    matrix = np.full((len(dates), len(tickers)), np.nan)
+    matrix[date_idx, ticker_idx] = long_df['price'].to_numpy(dtype='float64')
+
+    wide_df = pd.DataFrame(matrix, columns=tickers.tolist())
+    wide_df.insert(0, 'date', dates)
+    wide_df.insert(0, '_id', dates)
+    return wide_df
 
 
 
@@ -26,33 +108,145 @@ class __MarketPrices:
         The latest date for which market data is needed.
     needed_tickers : list
         A list of all required tickers based on the given source data.
+    storage : str
+        'wide' (one document per date, one field per ticker, in collection_name), 'long' (one (date, ticker, price)
+        document per price, in collection_name + '_long') or 'arrow' (local PriceStore named collection_name, refreshed
+        by missing interval of each ticker). The default is MARKET_STORAGE.
+    source : PriceSource
+        Prices provider of the downloads (default_price_source()).
+    price_status : PriceSourceStatus
+        Download status of the tickers, the delisted tickers are not requested again.
     '''
 
-    def __init__(self, collection_name, source_collection_lst, source_columns_names):
-        self.collection = CollectionConnect(database_name='capital_vault', collection_name=collection_name)
-        self.data = self.collection.document_query({})
+    def __init__(self, collection_name, source_collection_lst, source_columns_names, storage=None):
+        self.storage = storage or MARKET_STORAGE
+        self.source = default_price_source()
+        self.price_status = PriceSourceStatus(collection_name)
+        if self.storage == 'arrow':
+            self.store = PriceStore(collection_name)
+        else:
+            collection_name = f'{collection_name}_long' if self.storage == 'long' else collection_name
+            self.collection = CollectionConnect(database_name='capital_vault', collection_name=collection_name)
+            ensure_collection_indexes(self.collection)
+        self.data = self._load_data()
         self.start_date, self.end_date, self.needed_tickers = self.__get_meta_data(source_collection_lst, source_columns_names)
 
 
+    def _get_prices(self, tickers, start_date, end_date=None):
+        ''' get_prices of the tickers not known to be delisted from start_date, recording the download status of the tickers. '''
+
+        delisted = self.price_status.delisted(tickers, start_date)
+        tickers = [ticker for ticker in tickers if ticker not in delisted]
+        if not tickers:
+            return pd.DataFrame(index=pd.DatetimeIndex([], name='Date')), {}
+        prices, failures = get_prices(tickers, start_date=start_date, end_date=end_date, source=self.source)
+        self.price_status.update(tickers, start_date, failures, self.source.last_dates)
+        return prices, failures
+
+
+    def _load_data(self):
+        ''' Reads the stored prices as a wide df (date, _id and one column per ticker), pivoting them if stored in long format. '''
+
+        if self.storage == 'arrow':
+            return self.store.read_wide()
+        if self.storage == 'long':
+            return pivot_prices(self.collection.document_query(projection=['date', 'ticker', 'price'], columnar=True))
+        return self.collection.document_query(columnar=True)
+
+
+    def _write_data(self, wide_df):
+        ''' Writes a wide prices df (date, _id and one column per ticker) to the collection. '''
+
+        if self.storage == 'long':
+            report = self.collection.collection_writer(melt_prices(wide_df), '_id')
+        else:
+            report = self.collection.collection_writer(wide_df, '_id')
+        ensure_collection_indexes(self.collection) # indexes of the fields stored by the first write (SQLite backend)
+        return report
+
+
+    def _write_columns(self, new_prices, columns):
+        ''' Writes the prices of new tickers for the stored dates and patches self.data with them (no reload of the collection).
+
+        Only the new fields are sent: $set of the ticker columns on the stored date documents in wide format, insertion
+        of the (date, ticker, price) documents in long format.
+
+        Parameters
+        ----------
+        new_prices : pandas.DataFrame
+            Prices of the new tickers, one row per row of self.data (same order).
+        columns : list
+            New tickers (columns of new_prices).
+        '''
+
+        patch = self.data[['_id', 'date']].copy()
+        patch[columns] = new_prices[columns].to_numpy()
+        if self.storage == 'long':
+            self.collection.collection_writer(melt_prices(patch, columns), '_id')
+        else:
+            self.collection.field_updater(patch, columns, '_id')
+        self.data[columns] = patch[columns]
+
+
+    def _update_store(self, symbols):
+        ''' Downloads the missing intervals of each ticker of the price store, from start_date to today, and reloads self.data.
+
+        The tickers missing the same interval are downloaded together (one get_prices call per interval). An interval is
+        only covered for the tickers that returned prices, up to the last date returned by the price source (the prices
+        of the last days can be published later): the failed tickers stay missing and are requested again by the next
+        update. The intervals without any business day are left for a later update (week-end only gaps).
+
+        Parameters
+        ----------
+        symbols : dict
+            Source ticker (ex: 'USDCHF=X') per stored ticker (ex: 'USDCHF'), None for a constant price of 1 (ex: 'CHFCHF').
+        '''
+
+        if pd.isna(self.start_date):
+            return
+        missing_intervals = {}
+        for ticker in symbols:
+            for interval in self.store.missing_intervals(ticker, self.start_date, pd.Timestamp.today()):
+                missing_intervals.setdefault(interval, []).append(ticker)
+
+        for (start, end), tickers in sorted(missing_intervals.items()):
+            if pd.bdate_range(start, end).empty:
+                continue
+            for ticker in tickers:
+                if symbols[ticker] is None: # constant prices, nothing to download
+                    self.store.write(ticker, pd.Series(1.0, index=pd.bdate_range(start, end)), start, end)
+
+            source_tickers = {symbols[ticker]: ticker for ticker in tickers if symbols[ticker] is not None}
+            if not source_tickers:
+                continue
+            prices, failures = self._get_prices(list(source_tickers), start, end_date=end + pd.Timedelta(days=1))
+            if prices.empty:
+                continue
+            covered_end = min(end, prices.index.max().normalize())
+            for source_ticker, ticker in source_tickers.items():
+                if source_ticker in prices.columns and source_ticker not in failures:
+                    self.store.write(ticker, prices[source_ticker].loc[:covered_end], start, covered_end)
+        self.data = self._load_data()
+
+
     def __get_meta_data(self, collection_lst, columns_names_lst):
         '''
         Fetches metadata from cash flows and securities ledger collections to determine:
         - The range of dates required.
         - The list of unique currencies needed.
-        '''
 
-        collections = [CollectionConnect(database_name='capital_vault', collection_name=collection) for collection in collection_lst]
-        meta_dfs = []
-        for idx in range(len(collection_lst)):
-            meta_df = collections[idx].document_query({})[columns_names_lst[idx]]
-            meta_df.columns = ['date', 'ticker']
-            meta_dfs.append(meta_df)
+        The bounds and distinct values are computed by the database on the indexed fields, no ledger document is downloaded.
+        '''
 
-        combined_meta = pd.concat(meta_dfs)
-        start_date =  combined_meta['date'].min()
-        end_date = combined_meta['date'].max()
-        unique_ccy = combined_meta['ticker'].unique().tolist()
-        return start_date, end_date, unique_ccy
+        start_dates, end_dates, unique_ccy = [], [], []
+        for collection_name, (date_col, ticker_col) in zip(collection_lst, columns_names_lst):
+            collection = CollectionConnect(database_name='capital_vault', collection_name=collection_name)
+            ensure_collection_indexes(collection)
+            start_date, end_date = collection.date_bounds(date_col)
+            start_dates.append(start_date)
+            end_dates.append(end_date)
+            unique_ccy += [ticker for ticker in collection.distinct_values(ticker_col) if ticker not in unique_ccy]
+        return pd.DatetimeIndex(start_dates).min(), pd.DatetimeIndex(end_dates).max(), unique_ccy
 
 
 
@@ -68,9 +262,9 @@ class ForexData(__MarketPrices):
         Updates the FX matrix data by fetching missing data and writing it to the database.
     '''
 
-    def __init__(self):
+    def __init__(self, storage=None):
         super().__init__(collection_name='fx_matrix', source_collection_lst=['cash_flows', 'securities_ledger'], source_columns_names=
-                         [['date', 'currency'], ['date', 'quote_currency']])
+                         [['date', 'currency'], ['date', 'quote_currency']], storage=storage)
         self.needed_tickers = ['GBP' if ticker == 'GBX' else ticker for ticker in self.needed_tickers]
 
 
@@ -88,14 +282,14 @@ class ForexData(__MarketPrices):
             currencies.remove('CHF')
             currencies = [ccy + 'CHF=X' for ccy in currencies]
 
-            fx_matrix = get_prices(currencies, start_date=min(dates_to_fetch))
+            fx_matrix, _ = self._get_prices(currencies, min(dates_to_fetch))
             fx_matrix.reset_index(inplace=True)
             fx_matrix['CHFCHF'] = 1
             fx_matrix['_id'] = fx_matrix['Date']
             fx_matrix.rename(columns={'Date':'date'}, inplace=True)
             fx_matrix.columns = [column.split('=X')[0] for column in fx_matrix.columns]
-            self.collection.collection_writer(fx_matrix, '_id')
-            self.data = self.collection.document_query({})
+            self._write_data(fx_matrix)
+            self.data = self._load_data()
 
 
     def __add_missing_currencies(self):
@@ -110,19 +304,21 @@ class ForexData(__MarketPrices):
         if missing_ccy != ['CHF']:
             missing_ccy.remove('CHF')
             missing_ccy = [ccy + 'CHF=X' for ccy in missing_ccy]
-            missing_data = get_prices(missing_ccy, start_date=self.start_date)
-            missing_data = missing_data.loc[missing_data.index.isin(self.data['date'])]
-
-            missing_ccy = [ccy.split('=X')[0] for ccy in missing_ccy]
-            complete_data = self.data.copy()
-            complete_data[missing_ccy] = missing_data.values
-            self.collection.collection_writer(complete_data, '_id')
-            self.data = self.collection.document_query({})
+            missing_data, _ = self._get_prices(missing_ccy, self.start_date)
+            missing_data = missing_data.reindex(self.data['date'])
+            missing_data.columns = [ccy.split('=X')[0] for ccy in missing_data.columns]
+            if not missing_data.columns.empty:
+                self._write_columns(missing_data, missing_data.columns.tolist())
 
 
     def update_fx_data(self):
         ''' Method to update the FX collection. '''
 
+        if self.storage == 'arrow':
+            self._update_store({f'{ccy}CHF': None if ccy == 'CHF' else f'{ccy}CHF=X' for ccy in self.needed_tickers})
+            print('\033[1;32mFX matrix store update:\033[37m\033[3m The data is complete.\033[0m')
+            return
+
         start_date = (min(self.data['date']) if not self.data.empty else self.start_date).tz_localize('UTC')
         actual_dates_range = pd.date_range(start=start_date, end=self.end_date.tz_localize('UTC'))
         dates_to_fetch = actual_dates_range[actual_dates_range > max(self.data['date']).tz_localize('UTC')] if not self.data.empty else actual_dates_range
@@ -153,9 +349,9 @@ class SecuritiesData(__MarketPrices):
         Updates the securities data by fetching missing data and writing it to the database.
     '''
 
-    def __init__(self):
+    def __init__(self, storage=None):
         super().__init__(collection_name='market_prices', source_collection_lst=['securities_ledger', 'cryptos_ledger'], source_columns_names=
-                         [['date', 'ticker'], ['date', 'ticker']])
+                         [['date', 'ticker'], ['date', 'ticker']], storage=storage)
         self.ticker_corr = pd.read_excel(r'C:/Users/const/Documents/Code/Python/PlutusForge/plutus-lens/src/plutus_lens/services/ticker_corr.xlsx')
 
 
@@ -172,12 +368,12 @@ class SecuritiesData(__MarketPrices):
         if dates_to_fetch.empty==False:
             tickers = self.needed_tickers.copy()
 
-            prices_df = get_prices(tickers, start_date=min(dates_to_fetch))
+            prices_df, _ = self._get_prices(tickers, min(dates_to_fetch))
             prices_df.reset_index(inplace=True)
             prices_df['_id'] = prices_df['Date']
             prices_df.rename(columns={'Date':'date'}, inplace=True)
-            self.collection.collection_writer(prices_df, '_id')
-            self.data = self.collection.document_query({})
+            self._write_data(prices_df)
+            self.data = self._load_data()
 
 
     def __add_missing_tickers(self):
@@ -187,30 +383,27 @@ class SecuritiesData(__MarketPrices):
         actual_tickers.remove('_id')
         actual_tickers.remove('date')
         missing_tickers = list(filter(lambda x: x not in actual_tickers, self.needed_tickers))
-        missing_tickers_filtered = list(filter(lambda x: x not in ['ATVI', 'RADCQ', 'TUI.L', 'EVVAQ'], missing_tickers))
 
-        if missing_tickers_filtered != []:
-            missing_data = get_prices(missing_tickers_filtered, start_date=self.start_date)
-            missing_data = missing_data.loc[missing_data.index.isin(self.data['date'])]
-            missing_data = missing_data.reset_index()
-            missing_data.rename(columns={'Date':'date'}, inplace=True)
-
-            complete_data = self.data.copy()
-            complete_data_merged = pd.merge(complete_data, missing_data, on='date', how='left')
-            complete_data_merged[missing_tickers_filtered] = complete_data_merged[missing_tickers_filtered].ffill()
-            self.collection.collection_writer(complete_data_merged, '_id')
-            self.data = self.collection.document_query({})
+        if missing_tickers != []:
+            missing_data, _ = self._get_prices(missing_tickers, self.start_date)
+            missing_data = missing_data.reindex(self.data['date'])
+            if not missing_data.columns.empty: # delisted tickers without any price are skipped (and not requested again by the next updates)
+                self._write_columns(missing_data.ffill(), missing_data.columns.tolist())
 
 
     def update_market_data(self):
         ''' Method to update the market_prices collection. '''
 
+        self.needed_tickers = [ticker.replace('.US', '') for ticker in self.needed_tickers]
+        if self.storage == 'arrow':
+            self._update_store({ticker: ticker for ticker in self.needed_tickers})
+            print('\033[1;32mmarket_prices store update:\033[37m\033[3m The data is complete.\033[0m')
+            return
+
         start_date = (min(self.data['date']) if not self.data.empty else self.start_date).tz_localize('UTC')
         actual_dates_range = pd.date_range(start=start_date, end=self.end_date.tz_localize('UTC'))
         dates_to_fetch = actual_dates_range[actual_dates_range > max(self.data['date']).tz_localize('UTC')] if not self.data.empty else actual_dates_range
 
-        self.needed_tickers = [ticker.replace('.US', '') for ticker in self.needed_tickers]
-
         self.__add_missing_dates(dates_to_fetch)
         self.__add_missing_tickers()
         print('\033[1;32mmarket_prices query update:\033[37m\033[3m The data is complete.\033[0m')
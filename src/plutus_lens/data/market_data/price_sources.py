@@ -0,0 +1,183 @@
+''' Daily prices providers behind get_prices: a Yahoo Finance downloader (tickers split into chunks fetched
+concurrently, with retries) and an offline provider reading one CSV file per ticker (tests and benchmarks). '''
+
+import os
+import time
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+try:
+    import yfinance as yf
+except ImportError: # optional, only needed by YahooPriceSource
+    yf = None
+
+
+PRICE_SOURCE_DIR = os.environ.get('capital_tracker_price_source_dir') # offline prices folder, Yahoo Finance is used if not set
+PRICE_CHUNK_SIZE = 20
+MAX_CONCURRENT_CHUNKS = 4
+NO_PRICES = 'no prices returned' # failure of a ticker answered without any price (unlike the price source errors)
+
+
+
+
+def _naive_timestamp(date):
+    ''' Timestamp of a date without timezone (UTC time for a timezone aware date), comparable with the prices dates. '''
+
+    stamp = pd.Timestamp(date)
+    return stamp.tz_convert(None) if stamp.tzinfo else stamp
+
+
+
+
+class PriceSource(ABC):
+    ''' Base class of the prices providers: downloads the tickers by chunks and keeps track of the tickers without prices.
+
+    The subclasses implement _fetch_chunk(tickers, start_date, end_date), returning the daily prices of the tickers
+    (one column per ticker, indexed by date). The tickers of a chunk missing from its output or without any price
+    (the providers rarely raise on a single ticker failure) are requested again, as the chunks that raise. The tickers
+    still without prices after the retries do not stop the other chunks, they are recorded in failures (returned by
+    download) and can be requested again later.
+
+    Attributes
+    ----------
+    chunk_size : int, optional
+        Number of tickers per request (default is PRICE_CHUNK_SIZE).
+    max_workers : int, optional
+        Number of chunks fetched concurrently (default is MAX_CONCURRENT_CHUNKS).
+    max_retries : int, optional
+        Number of retries of a failing chunk (default is 3).
+    backoff : float, optional
+        Delay before the first retry in seconds, doubled at each retry (default is 1).
+    failures : dict
+        Error message of each ticker without prices during the last download.
+    last_dates : dict
+        Date of the last available price of each ticker downloaded so far (recorded by PriceSourceStatus).
+    '''
+
+    def __init__(self, chunk_size=PRICE_CHUNK_SIZE, max_workers=MAX_CONCURRENT_CHUNKS, max_retries=3, backoff=1.0):
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.failures = {}
+        self.last_dates = {}
+        self.__lock = threading.Lock()
+
+
+    @abstractmethod
+    def _fetch_chunk(self, tickers, start_date=None, end_date=None):
+        ''' Returns the daily prices of the tickers (one column per ticker, indexed by date). '''
+
+
+    def __fetch_with_retries(self, tickers, start_date, end_date):
+        ''' Fetches a chunk, requesting again (with backoff) the tickers that raised or came back without any price. '''
+
+        fetched, missing, errors = [], list(tickers), {}
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2**(attempt - 1))
+            try:
+                prices = self._fetch_chunk(missing, start_date, end_date)
+            except Exception as error: # provider errors are not typed (network, parsing, rate limiting)
+                errors = {ticker: f'{type(error).__name__}: {error}' for ticker in missing}
+                continue
+            prices = prices.loc[:, [ticker for ticker in missing if ticker in prices.columns and prices[ticker].notna().any()]]
+            fetched.append(prices)
+            missing = [ticker for ticker in missing if ticker not in prices.columns]
+            errors = {ticker: NO_PRICES for ticker in missing}
+            if not missing:
+                break
+        with self.__lock:
+            self.failures.update(errors)
+        return pd.concat(fetched, axis=1) if fetched else pd.DataFrame()
+
+
+    def download(self, tickers, start_date=None, end_date=None):
+        ''' Downloads the daily prices of the tickers.
+
+        Parameters
+        ----------
+        tickers : list
+            Tickers to be downloaded.
+        start_date : datetime, optional
+            First date of the prices (full history if not specified).
+        end_date : datetime, optional
+            Last date of the prices (exclusive, today if not specified).
+
+        Returns
+        -------
+        prices : pandas.DataFrame
+            Prices indexed by Date, one column per ticker with prices.
+        failures : dict
+            Error message per ticker without prices after the retries (also kept in the failures attribute).
+        '''
+
+        tickers = list(dict.fromkeys(tickers))
+        self.failures = {}
+        chunks = [tickers[start:start + self.chunk_size] for start in range(0, len(tickers), self.chunk_size)]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(chunks)))) as executor:
+            chunk_prices = list(executor.map(lambda chunk: self.__fetch_with_retries(chunk, start_date, end_date), chunks))
+
+        chunk_prices = [chunk for chunk in chunk_prices if not chunk.empty]
+        prices = pd.concat(chunk_prices, axis=1) if chunk_prices else pd.DataFrame(index=pd.DatetimeIndex([]))
+        prices = prices.loc[:, ~prices.columns.duplicated()].dropna(axis=1, how='all').sort_index()
+        for ticker in tickers:
+            if ticker in prices.columns:
+                self.last_dates[ticker] = prices[ticker].last_valid_index()
+            else:
+                self.failures.setdefault(ticker, NO_PRICES)
+        prices.index.name = 'Date'
+        return prices[[ticker for ticker in tickers if ticker in prices.columns]], dict(self.failures)
+
+
+
+
+class YahooPriceSource(PriceSource):
+    ''' Yahoo Finance adjusted close prices (yfinance). '''
+
+    def _fetch_chunk(self, tickers, start_date=None, end_date=None):
+        if yf is None:
+            raise ImportError('yfinance is required by YahooPriceSource')
+        prices = yf.download(tickers, start=start_date, end=end_date, interval='1d', auto_adjust=False, progress=False, threads=False)['Adj Close']
+        return prices.to_frame(tickers[0]) if isinstance(prices, pd.Series) else prices
+
+
+
+
+class FilePriceSource(PriceSource):
+    ''' Offline prices read from {directory}/{ticker}.csv files (Date and Adj Close columns, as saved from Yahoo Finance).
+
+    Attributes
+    ----------
+    directory : str, optional
+        Folder of the prices files, PRICE_SOURCE_DIR if not specified.
+    '''
+
+    def __init__(self, directory=None, **kwargs):
+        super().__init__(**{'backoff': 0.0, **kwargs})
+        self.directory = directory or PRICE_SOURCE_DIR
+
+
+    def _fetch_chunk(self, tickers, start_date=None, end_date=None):
+        prices = {}
+        for ticker in tickers:
+            path = os.path.join(self.directory, f'{ticker}.csv')
+            if os.path.isfile(path):
+                prices[ticker] = pd.read_csv(path, index_col='Date', parse_dates=['Date'])['Adj Close']
+        prices = pd.DataFrame(prices, index=None if prices else pd.DatetimeIndex([], name='Date'))
+        if start_date is not None:
+            prices = prices.loc[prices.index >= _naive_timestamp(start_date)]
+        if end_date is not None:
+            prices = prices.loc[prices.index < _naive_timestamp(end_date)]
+        return prices
+
+
+
+
+def default_price_source():
+    ''' FilePriceSource if the capital_tracker_price_source_dir environment variable is set, YahooPriceSource otherwise. '''
+
+    return FilePriceSource() if PRICE_SOURCE_DIR else YahooPriceSource()
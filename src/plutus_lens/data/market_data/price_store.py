@@ -0,0 +1,164 @@
+''' Local columnar store of the daily prices: one uncompressed Arrow (Feather v2) file per ticker, read through memory
+maps, and a coverage file recording the date intervals already downloaded for each ticker, so that a refresh only
+fetches the exact missing intervals of each ticker (new tickers, new dates and holes in the history). '''
+
+import os
+import json
+import threading
+
+import pandas as pd
+
+try:
+    from pyarrow import feather
+except ImportError: # optional, only needed by the 'arrow' market storage
+    feather = None
+
+
+PRICE_STORE_DIR = os.environ.get('capital_tracker_price_store_dir', os.path.join(os.path.expanduser('~'), '.plutus_lens', 'price_store'))
+COVERAGE_NAME = 'coverage.json'
+
+ONE_DAY = pd.Timedelta(days=1)
+
+
+
+
+def _day(date):
+    ''' Day of a date, without timezone (UTC day for a timezone aware date). '''
+
+    stamp = pd.Timestamp(date)
+    return (stamp.tz_convert(None) if stamp.tzinfo else stamp).normalize()
+
+
+def _merge_intervals(intervals):
+    ''' Sorts and coalesces (start, end) day intervals, the overlapping and adjacent intervals are merged. '''
+
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + ONE_DAY:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+
+
+class PriceStore:
+    ''' Class meant to read / write a folder of daily prices (ex: the FX rates or the market prices).
+
+    Each ticker is stored in {directory}/{name}/{ticker}.arrow (date and price columns, sorted by date). The coverage
+    file holds, per ticker, the (start, end) days already requested from the price source: a covered day without
+    price is a day without quotation (week-end, holiday, delisted ticker) and is not requested again.
+
+    Attributes
+    ----------
+    name : str
+        Name of the store (sub-folder, ex: 'fx_matrix').
+    directory : str, optional
+        Root folder of the stores, PRICE_STORE_DIR (capital_tracker_price_store_dir environment variable) if not specified.
+    coverage : dict
+        Covered (start, end) day intervals per ticker.
+    '''
+
+    def __init__(self, name, directory=None):
+        if feather is None:
+            raise ImportError('pyarrow is required by the price store')
+        self.name = name
+        self.path = os.path.join(directory or PRICE_STORE_DIR, name)
+        self.__lock = threading.Lock()
+        self.coverage = self.__read_coverage()
+
+
+    def __ticker_path(self, ticker):
+        return os.path.join(self.path, f'{ticker}.arrow')
+
+
+    def __read_coverage(self):
+        coverage_path = os.path.join(self.path, COVERAGE_NAME)
+        if not os.path.isfile(coverage_path):
+            return {}
+        with open(coverage_path, encoding='utf-8') as coverage_file:
+            stored = json.load(coverage_file)
+        return {ticker: [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in intervals] for ticker, intervals in stored.items()}
+
+
+    def __write_coverage(self):
+        coverage_path = os.path.join(self.path, COVERAGE_NAME)
+        stored = {ticker: [[start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')] for start, end in intervals] for ticker, intervals in self.coverage.items()}
+        with open(f'{coverage_path}.tmp', 'w', encoding='utf-8') as coverage_file:
+            json.dump(stored, coverage_file, indent=1, sort_keys=True)
+        os.replace(f'{coverage_path}.tmp', coverage_path)
+
+
+    def tickers(self):
+        return sorted(ticker for ticker in self.coverage if os.path.isfile(self.__ticker_path(ticker)))
+
+
+    def missing_intervals(self, ticker, start, end):
+        ''' Returns the (start, end) day intervals (inclusive) between start and end not covered yet for the ticker. '''
+
+        start, end = _day(start), _day(end)
+        missing = []
+        for covered_start, covered_end in self.coverage.get(ticker, []):
+            if covered_end < start:
+                continue
+            if covered_start > end:
+                break
+            if covered_start > start:
+                missing.append((start, covered_start - ONE_DAY))
+            start = max(start, covered_end + ONE_DAY)
+        if start <= end:
+            missing.append((start, end))
+        return missing
+
+
+    def read_ticker(self, ticker):
+        ''' Returns the stored prices of a ticker (Series indexed by date), read through a memory map. '''
+
+        if not os.path.isfile(self.__ticker_path(ticker)):
+            return pd.Series(dtype='float64', name=ticker, index=pd.DatetimeIndex([], name='date'))
+        table = feather.read_table(self.__ticker_path(ticker), memory_map=True)
+        return table.to_pandas().set_index('date')['price'].rename(ticker)
+
+
+    def write(self, ticker, prices, start, end):
+        ''' Merges downloaded prices into the ticker file and marks [start, end] as covered.
+
+        Parameters
+        ----------
+        ticker : str
+            Name of the ticker (file name).
+        prices : pandas.Series
+            Prices indexed by date, the stored prices of the same dates are replaced.
+        start, end : datetime
+            Requested interval (inclusive), covered even on the days without price (only to be written for a ticker the
+            price source actually answered for, a failed download must leave the interval missing).
+        '''
+
+        with self.__lock:
+            os.makedirs(self.path, exist_ok=True)
+            prices = prices.dropna().astype('float64')
+            if not prices.empty:
+                prices.index = pd.DatetimeIndex([_day(date) for date in prices.index])
+                stored = self.read_ticker(ticker)
+                merged = pd.concat([stored.loc[~stored.index.isin(prices.index)], prices]).sort_index()
+                ticker_df = pd.DataFrame({'date': merged.index.as_unit('ns'), 'price': merged.to_numpy()})
+                temp_path = f'{self.__ticker_path(ticker)}.tmp'
+                feather.write_feather(ticker_df, temp_path, compression='uncompressed') # uncompressed for zero-copy memory maps
+                os.replace(temp_path, self.__ticker_path(ticker))
+            self.coverage[ticker] = _merge_intervals(self.coverage.get(ticker, []) + [(_day(start), _day(end))])
+            self.__write_coverage()
+
+
+    def read_wide(self, tickers=None):
+        ''' Returns the stored prices as a wide df (_id and date columns, as in the wide collection storage, and one column per ticker). '''
+
+        tickers = self.tickers() if tickers is None else tickers
+        series = [self.read_ticker(ticker) for ticker in tickers]
+        series = [prices for prices in series if not prices.empty]
+        if not series:
+            return pd.DataFrame()
+        wide_df = pd.concat(series, axis=1).sort_index()
+        wide_df.insert(0, 'date', wide_df.index)
+        wide_df.insert(0, '_id', wide_df.index)
+        return wide_df.reset_index(drop=True)
@@ -1,9 +1,124 @@
+import os
+import re
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from src.plutus_lens.data.database_schema import apply_ledger_schema
+from src.plutus_lens.data.platform_data._parse_cache import cached_read
+
+
+EXCEL_ENGINE = 'calamine' if importlib.util.find_spec('python_calamine') else None # faster read-only engine when installed (pandas default otherwise)
+CSV_ENGINE = 'pyarrow' if importlib.util.find_spec('pyarrow') else None # multithreaded CSV parser when installed (pandas C engine otherwise)
+FRENCH_MONTHS = {'janv.': 'Jan', 'févr.': 'Feb', 'mars': 'Mar', 'avr.': 'Apr', 'mai': 'May', 'juin': 'Jun',
+                 'juil.': 'Jul', 'août': 'Aug', 'sept.': 'Sep', 'oct.': 'Oct', 'nov.': 'Nov', 'déc.': 'Dec'}
+FRENCH_MONTHS_PATTERN = re.compile('|'.join(re.escape(month) for month in sorted(FRENCH_MONTHS, key=len, reverse=True)))
+
 
 
 def collection_config(dataframe, collection_name, amount_col='amount', ccy_col='currency'):
     return {
-        'DataFrame': dataframe,
+        'DataFrame': apply_ledger_schema(dataframe, cast_floats=False),
         'destination_collection': collection_name,
         'amount_col': amount_col,
         'ccy_col': ccy_col
     }
+
+
+
+def filter_since(dfs_list, since=None):
+    ''' Keeps only the records dated on or after since in each collection config (all the records if since is None). '''
+
+    if since is None:
+        return dfs_list
+    since = pd.to_datetime(since, utc=True)
+    for config in dfs_list:
+        df = config['DataFrame']
+        config['DataFrame'] = df.loc[pd.to_datetime(df['date'], utc=True) >= since]
+    return dfs_list
+
+
+
+def read_workbook(path, sheets):
+    ''' Reads several sheets of a workbook in a single pass (the file is opened and parsed once).
+
+    Parameters
+    ----------
+    path : str
+        Path of the Excel workbook.
+    sheets : dict
+        Columns to be read per sheet name (ex: {'cash_flows': ['Currency', 'Amount']}), None to read all the columns.
+
+    Returns
+    -------
+    dict
+        DataFrame per sheet name.
+    '''
+
+    with pd.ExcelFile(path, engine=EXCEL_ENGINE) as workbook:
+        return {sheet_name: workbook.parse(sheet_name, usecols=usecols) for sheet_name, usecols in sheets.items()}
+
+
+
+def translate_french_months(text_col):
+    ''' Replaces the French month names (ex: 'févr.') by their English abbreviations (ex: 'Feb') in a single regex pass. '''
+
+    return text_col.str.replace(FRENCH_MONTHS_PATTERN, lambda match: FRENCH_MONTHS[match.group(0)], regex=True)
+
+
+
+def parse_dates(date_col, date_format, french_months=False):
+    ''' Parses a column of date strings with an explicit format, each distinct string being translated / parsed once.
+
+    Parameters
+    ----------
+    date_col : pandas.Series
+        Date strings (the missing values give NaT).
+    date_format : str
+        strptime format of the dates (ex: '%d %b %Y, %H:%M:%S').
+    french_months : bool, optional
+        If True, the French month names are translated to English before parsing (default is False).
+
+    Returns
+    -------
+    pandas.Series
+        Parsed dates, with the index of date_col.
+    '''
+
+    codes, unique_dates = pd.factorize(date_col)
+    unique_dates = pd.Series(unique_dates, dtype=object)
+    if french_months:
+        unique_dates = translate_french_months(unique_dates)
+    parsed_dates = pd.DatetimeIndex(pd.to_datetime(unique_dates, format=date_format))
+    return pd.Series(parsed_dates.take(codes, allow_fill=True, fill_value=pd.NaT), index=date_col.index, name=date_col.name)
+
+
+
+def read_csv_directory(directory, dtype, max_workers=None):
+    ''' Reads all the CSV files of a directory concurrently (through the parse cache) and concatenates them.
+
+    Parameters
+    ----------
+    directory : str
+        Folder of the CSV files, read in file name order.
+    dtype : dict
+        dtype per column, only these columns are read (no dtype inference).
+    max_workers : int, optional
+        Maximum number of files read concurrently (ThreadPoolExecutor default if not specified).
+
+    Returns
+    -------
+    pandas.DataFrame
+        Rows of all the files, with a new RangeIndex (empty frame with the dtype columns if the directory is missing or
+        holds no CSV file).
+    '''
+
+    csv_files = sorted(file for file in os.listdir(directory) if '.csv' in file) if os.path.isdir(directory) else []
+    if not csv_files:
+        return pd.DataFrame({column: pd.Series(dtype=column_dtype) for column, column_dtype in dtype.items()})
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        csv_frames = list(pool.map(
+            lambda file: cached_read(os.path.join(directory, file), pd.read_csv, usecols=list(dtype), dtype=dtype, engine=CSV_ENGINE),
+            csv_files))
+    return pd.concat(csv_frames, ignore_index=True)
@@ -0,0 +1,142 @@
+''' Ingestion watermarks of the platforms data (last ingested record and running balances per platform and destination
+collection), stored in the capital_vault ingestion_watermarks collection and used for incremental refreshes. '''
+
+import json
+
+import pandas as pd
+
+from src.plutus_lens.data import CollectionConnect
+
+
+
+
+class IngestionWatermarks:
+    ''' Class meant to read / update the ingestion watermarks.
+
+    Each watermark document (_id '{platform} - {destination_collection}') holds:
+    - last_date: date of the last ingested record (UTC).
+    - balances: JSON of the running balance_by_cat state, (sum, compensation) per '{currency} - {platform} - {type}'
+      category, after the last ingested record.
+    - resume_date: start (UTC) of the day of last_date. Several sources are only dated by day, so a record of that day
+      can appear in a later export: the next refresh ingests the records again from resume_date (inclusive).
+    - resume_balances: JSON of the balance_by_cat state at resume_date, the cursor that lets balance_calc resume the
+      cumulative balances (and so generate the same _id as a full refresh).
+    - rows: number of records stored.
+    - resume_rows: number of records dated before resume_date, the stored records from resume_date are replaced by
+      the next incremental refresh.
+
+    Attributes
+    ----------
+    collection : CollectionConnect
+        Connection to the ingestion_watermarks collection.
+    watermarks : dict
+        Watermark documents by _id.
+    '''
+
+    def __init__(self):
+        self.collection = CollectionConnect(database_name='capital_vault', collection_name='ingestion_watermarks')
+        stored = self.collection.document_query({})
+        self.watermarks = {} if stored.empty else {document['_id']: document for document in stored.to_dict('records')}
+
+
+    @staticmethod
+    def watermark_id(platform, destination_collection):
+        return f'{platform} - {destination_collection}'
+
+
+    def platform_since(self, platform):
+        ''' Returns the oldest resume date of the platform destinations (None if the platform was never ingested).
+
+        Records older than it are already stored in every destination, so the platform extract can skip them. A
+        destination added to an already ingested platform needs a full refresh (data_feed(update=False)).
+        '''
+
+        resume_dates = [self.resume_date(platform, watermark['destination_collection'])
+                        for watermark in self.watermarks.values() if watermark['platform'] == platform]
+        return min(resume_dates) if resume_dates else None
+
+
+    def last_date(self, platform, destination_collection):
+        watermark = self.watermarks.get(self.watermark_id(platform, destination_collection))
+        return pd.to_datetime(watermark['last_date'], utc=True) if watermark else None
+
+
+    def balances(self, platform, destination_collection):
+        watermark = self.watermarks.get(self.watermark_id(platform, destination_collection))
+        return json.loads(watermark['balances']) if watermark else {}
+
+
+    def resume_date(self, platform, destination_collection):
+        ''' First date (inclusive) to be ingested again by the next incremental refresh (None if never ingested). '''
+
+        watermark = self.watermarks.get(self.watermark_id(platform, destination_collection))
+        if not watermark:
+            return None
+        if pd.isna(watermark.get('resume_date')): # watermark written before the resume dates, resumes after last_date
+            return pd.to_datetime(watermark['last_date'], utc=True) + pd.Timedelta(1, 'ns')
+        return pd.to_datetime(watermark['resume_date'], utc=True)
+
+
+    def resume_balances(self, platform, destination_collection):
+        ''' Running balances at resume_date (opening balances of the next incremental refresh). '''
+
+        watermark = self.watermarks.get(self.watermark_id(platform, destination_collection))
+        if not watermark:
+            return {}
+        return json.loads(watermark['resume_balances'] if isinstance(watermark.get('resume_balances'), str) else watermark['balances'])
+
+
+    def rows(self, platform, destination_collection):
+        watermark = self.watermarks.get(self.watermark_id(platform, destination_collection))
+        return int(watermark['rows']) if watermark else 0
+
+
+    def resume_rows(self, platform, destination_collection):
+        ''' Number of records dated before resume_date (None for a watermark written before the resume row counts). '''
+
+        watermark = self.watermarks.get(self.watermark_id(platform, destination_collection))
+        if not watermark:
+            return 0
+        return None if pd.isna(watermark.get('resume_rows')) else int(watermark['resume_rows'])
+
+
+    def update(self, platform, destination_collection, last_date, balances, rows, resume_balances, resume_rows):
+        ''' Moves the watermark of a platform destination to the last written record.
+
+        The records are written in chronological order from the resume date (or from the start of the history for a full
+        refresh), so the watermark always matches the stored records, even if the refresh is interrupted.
+
+        Parameters
+        ----------
+        platform : str
+            Name of the platform (as in PLATFORMS).
+        destination_collection : str
+            Name of the destination collection attribute (ex: 'collection_cash_flows').
+        last_date : pandas.Timestamp
+            Date of the last record written.
+        balances : dict
+            Running balances per category after the write.
+        rows : int
+            Number of records stored after the write.
+        resume_balances : dict
+            Running balances per category at the start of the day of last_date.
+        resume_rows : int
+            Number of records dated before the day of last_date.
+        '''
+
+        last_date = pd.to_datetime(last_date, utc=True)
+        watermark_id = self.watermark_id(platform, destination_collection)
+        watermark = {
+            '_id': watermark_id,
+            'platform': platform,
+            'destination_collection': destination_collection,
+            'last_date': last_date,
+            'balances': json.dumps(balances, sort_keys=True),
+            'resume_date': last_date.normalize(),
+            'resume_balances': json.dumps(resume_balances, sort_keys=True),
+            'rows': int(rows),
+            'resume_rows': int(resume_rows),
+            'updated_at': pd.Timestamp.now(tz='UTC'),
+        }
+        self.collection.collection_writer(pd.DataFrame([watermark]), '_id', skip_unchanged=False)
+        self.watermarks[watermark_id] = watermark
@@ -0,0 +1,144 @@
+''' Fingerprinted parse cache of the raw statement files: a manifest records the size, modification time and content
+hash of each parsed file, with the parsed frames cached in Parquet (pickle when pyarrow is missing or the frame does
+not round-trip), so that only the new or modified statements are parsed again. '''
+
+import os
+import json
+import hashlib
+import threading
+
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+PARSE_CACHE_DIR = os.environ.get('capital_tracker_parse_cache_dir', os.path.join(os.path.expanduser('~'), '.plutus_lens', 'parse_cache'))
+MANIFEST_NAME = 'manifest.json'
+
+_MANIFEST_LOCK = threading.Lock()
+
+
+
+
+def file_sha256(path, block_size=2**20):
+    ''' Returns the SHA-256 hex digest of a file content, read by blocks. '''
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as raw_file:
+        for block in iter(lambda: raw_file.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+
+def _read_manifest(cache_dir):
+    manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, encoding='utf-8') as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {} # unreadable manifest, every file is parsed again
+
+
+
+def _update_manifest(cache_dir, key, record):
+    ''' Writes a manifest record, merged into the current manifest and atomically replaced (a record lost to a
+    concurrent writer only costs a new parse). '''
+
+    with _MANIFEST_LOCK:
+        manifest = _read_manifest(cache_dir)
+        manifest[key] = record
+        manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+        temp_path = f'{manifest_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+        os.replace(temp_path, manifest_path)
+
+
+
+def _store_frame(frame, cache_path):
+    ''' Caches a frame in Parquet if it round-trips identically, in pickle otherwise, and returns the cache file name. '''
+
+    for previous_cache_file in (f'{cache_path}.parquet', f'{cache_path}.pkl'):
+        if os.path.isfile(previous_cache_file):
+            os.remove(previous_cache_file)
+    if pyarrow is not None:
+        try:
+            frame.to_parquet(f'{cache_path}.parquet')
+            if pd.read_parquet(f'{cache_path}.parquet').equals(frame):
+                return os.path.basename(f'{cache_path}.parquet')
+        except (ValueError, TypeError, pyarrow.ArrowException):
+            pass # mixed types object columns
+        if os.path.isfile(f'{cache_path}.parquet'):
+            os.remove(f'{cache_path}.parquet')
+    frame.to_pickle(f'{cache_path}.pkl')
+    return os.path.basename(f'{cache_path}.pkl')
+
+
+
+def _load_frame(cache_file):
+    return pd.read_parquet(cache_file) if cache_file.endswith('.parquet') else pd.read_pickle(cache_file)
+
+
+
+def cached_read(path, reader, cache_dir=None, **reader_kwargs):
+    ''' Returns reader(path, **reader_kwargs), loaded from the parse cache when the file did not change since it was parsed.
+
+    A file is unchanged when its size and modification time match the manifest, or when only its modification time
+    changed but its content hash still matches (the manifest is then updated).
+
+    Parameters
+    ----------
+    path : str
+        Path of the raw file.
+    reader : callable
+        Parsing function (ex: pd.read_excel, pd.read_csv), returning a DataFrame or a dict of DataFrames.
+    cache_dir : str, optional
+        Folder of the cache, PARSE_CACHE_DIR (capital_tracker_parse_cache_dir environment variable) if not specified.
+    **reader_kwargs
+        Arguments of the reader, part of the cache key (ex: sheet_name).
+
+    Returns
+    -------
+    pandas.DataFrame or dict
+        Parsed file.
+    '''
+
+    cache_dir = cache_dir or PARSE_CACHE_DIR
+    path = os.path.abspath(path)
+    reader_id = f'{reader.__module__}.{getattr(reader, "__qualname__", reader)}'
+    key = hashlib.sha1(json.dumps([path, reader_id, reader_kwargs], sort_keys=True, default=str).encode()).hexdigest()
+    file_stat = os.stat(path)
+
+    record = _read_manifest(cache_dir).get(key)
+    if record is not None and all(os.path.isfile(os.path.join(cache_dir, cache_file)) for _, cache_file in record['frames']):
+        unchanged = (record['size'], record['mtime_ns']) == (file_stat.st_size, file_stat.st_mtime_ns)
+        if not unchanged and record['size'] == file_stat.st_size and record['sha256'] == file_sha256(path):
+            _update_manifest(cache_dir, key, dict(record, mtime_ns=file_stat.st_mtime_ns)) # touched but not modified
+            unchanged = True
+        if unchanged:
+            frames = {name: _load_frame(os.path.join(cache_dir, cache_file)) for name, cache_file in record['frames']}
+            return frames[record['frames'][0][0]] if record['single_frame'] else frames
+
+    sha256 = file_sha256(path)
+    parsed = reader(path, **reader_kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    single_frame = isinstance(parsed, pd.DataFrame)
+    frames = {'': parsed} if single_frame else parsed
+    stored_frames = [[name, _store_frame(frame, os.path.join(cache_dir, f'{key}_{idx}'))] for idx, (name, frame) in enumerate(frames.items())]
+
+    _update_manifest(cache_dir, key, {
+        'path': path,
+        'reader': reader_id,
+        'size': file_stat.st_size,
+        'mtime_ns': file_stat.st_mtime_ns,
+        'sha256': sha256,
+        'single_frame': single_frame,
+        'frames': stored_frames,
+    })
+    return parsed
@@ -0,0 +1,48 @@
+''' Lazy registry of the platforms data extracts: the platforms are discovered from the platform_data sub-packages
+without importing them, and each extract module is only imported when it is requested. '''
+
+import importlib
+import os
+import pkgutil
+
+
+PLATFORM_PACKAGE = 'src.plutus_lens.data.platform_data'
+PLATFORM_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_LOADED_PLATFORMS = {}
+
+
+
+
+def discover_platforms():
+    ''' Lists the available platforms, i.e. the platform_data sub-packages holding a {platform}_data_extract module.
+
+    Returns
+    -------
+    list
+        Sorted platform names (ex: ['bcge', 'etoro', 'ibkr', 'kraken', 'revolut']).
+    '''
+
+    return sorted(module.name for module in pkgutil.iter_modules([PLATFORM_DIR])
+                  if module.ispkg and os.path.isfile(os.path.join(PLATFORM_DIR, module.name, f'{module.name}_data_extract.py')))
+
+
+def load_platform(platform):
+    ''' Imports (once) and returns the data extract module of a platform.
+
+    Parameters
+    ----------
+    platform : str
+        Name of the platform, as returned by discover_platforms.
+
+    Returns
+    -------
+    module
+        The {platform}_data_extract module, exposing main(since=None).
+    '''
+
+    if platform not in _LOADED_PLATFORMS:
+        if platform not in discover_platforms():
+            raise ValueError(f'Unknown platform: {platform} (available platforms: {discover_platforms()})')
+        _LOADED_PLATFORMS[platform] = importlib.import_module(f'{PLATFORM_PACKAGE}.{platform}.{platform}_data_extract')
+    return _LOADED_PLATFORMS[platform]
@@ -1,11 +1,12 @@
 import os
-import re
 import pandas as pd
 import numpy as np
 
 from .bcge_data_validation_test import test_bcge_data_extract
 # from bcge_data_validation_test import test_bcge_data_extract
 from src.plutus_lens.data import collection_config
+from src.plutus_lens.data.platform_data._data_extract_util import filter_since, parse_dates
+from src.plutus_lens.data.platform_data._parse_cache import cached_read
 
 
 RAW_DATA_PATH = os.environ.get("capital_tracker_raw_data")
@@ -14,39 +15,82 @@ EXCEL_EXTRACT_PATH = f'{RAW_DATA_PATH}/bcge/bcge_data_extraction.xlsx'
 
 
 def loading_and_preclean_data():
-    df = pd.read_excel(EXCEL_EXTRACT_PATH)
+    df = cached_read(EXCEL_EXTRACT_PATH, pd.read_excel)
 
     df['Column3'] = df['Column1'].fillna('') + ' ' + df['Column2'].fillna('') + ' ' + df['Column3'].fillna('')
     df['Column3'] = df['Column3'].replace('  ', np.nan)
     df.drop(columns=['Column1', 'Column2', 'Column13'], inplace=True)
 
+    # rows without any amount / date are wrapped description lines, merged into the description of the row above them
+    # (the wrapped lines before the first row go to the first row)
     mask = df.loc[:, 'Column4':'Column12'].isna().all(axis=1)
-    previous_index = None
-    merged_values = []
-
-    for idx in df.index:
-        if mask[idx]:
-            value = df.at[idx, 'Column3']
-            if pd.notna(value):
-                merged_values.append(str(value))
-        else:
-            if merged_values and previous_index is not None:
-                df.at[previous_index, 'Column3'] = f"{df.at[previous_index, 'Column3']} {' '.join(merged_values)}".strip()
-                merged_values = []
-            previous_index = idx
-
-    if merged_values and previous_index is not None:
-        df.at[previous_index, 'Column3'] = f"{df.at[previous_index, 'Column3']} {' '.join(merged_values)}".strip()
+    row_group = (~mask).cumsum().clip(lower=1)
+    wrapped_lines = df.loc[mask & df['Column3'].notna(), 'Column3']
+    merged_lines = (wrapped_lines.astype(str).astype(object) + ' ').groupby(row_group[wrapped_lines.index]).sum().str[:-1] # ' '.join per row
+
+    rows = df.loc[~mask & row_group.isin(merged_lines.index)].index
+    descriptions = df.loc[rows, 'Column3'].astype(object).map(str) + ' ' + merged_lines.loc[row_group[rows]].to_numpy()
+    df.loc[rows, 'Column3'] = descriptions.str.strip()
 
     df = df[~mask].reset_index(drop=True)
     return df
 
 
-def filtering_df(df, process_dict):
-    mask = df.loc[:, process_dict['mask_na']].isna().all(axis=1) & df.loc[:, process_dict['mask_notna']].notna().all(axis=1)
-    shifted_col = process_dict['shifted_col']
-    df.loc[mask, shifted_col] = df.loc[mask, shifted_col].shift(periods=process_dict['shifted_periods'], axis=1)
-    return df
+def shift_pattern(row_notna, columns, processing_list):
+    ''' Replays the mask-and-shift steps of a processing list on the missing values pattern of a row.
+
+    Parameters
+    ----------
+    row_notna : sequence
+        Not missing flag of each column of the row.
+    columns : list
+        Columns names.
+    processing_list : list
+        Processing steps (dicts of mask_notna, mask_na, shifted_col and shifted_periods), applied in order.
+
+    Returns
+    -------
+    list
+        Position of the source column of each column once shifted (-1 when the value is missing).
+    '''
+
+    positions = {column: position for position, column in enumerate(columns)}
+    sources = [position if notna else -1 for position, notna in enumerate(row_notna)]
+    for process_dict in processing_list:
+        if all(sources[positions[column]] == -1 for column in process_dict['mask_na']) and \
+                all(sources[positions[column]] != -1 for column in process_dict['mask_notna']):
+            shifted_positions = [positions[column] for column in process_dict['shifted_col']]
+            shifted_sources = [sources[position] for position in shifted_positions]
+            periods = process_dict['shifted_periods']
+            if periods < 0:
+                shifted_sources = shifted_sources[-periods:] + [-1] * -periods
+            elif periods > 0:
+                shifted_sources = [-1] * periods + shifted_sources[:-periods]
+            for position, source in zip(shifted_positions, shifted_sources):
+                sources[position] = source
+    return sources
+
+
+def shift_rows(df, processing_list):
+    ''' Applies the mask-and-shift steps of a processing list to all the rows in a single pass.
+
+    The steps only depend on which values of the row are missing, so the outcome is computed once per missing values
+    pattern (see shift_pattern), then every row is realigned with one gather from its pattern. The columns are returned
+    with the object dtype, as the masked shifts leave them (a shifted column mixes the values of several columns).
+    '''
+
+    if df.empty:
+        return df
+    notna = df.notna().to_numpy()
+    pattern_codes = notna @ (1 << np.arange(notna.shape[1]))
+    _, first_rows, row_patterns = np.unique(pattern_codes, return_index=True, return_inverse=True)
+    pattern_sources = np.array([shift_pattern(notna[row], df.columns, processing_list) for row in first_rows], dtype=np.int64)
+
+    sources = pattern_sources[row_patterns.ravel()]
+    sources[sources == -1] = notna.shape[1] # extra missing value column
+    values = np.column_stack([df.to_numpy(dtype=object), np.full(len(df), np.nan, dtype=object)])
+    shifted_values = np.take_along_axis(values, sources, axis=1)
+    return pd.DataFrame(shifted_values, index=df.index, columns=df.columns, dtype=object)
 
 
 def process_dataframe(df):
@@ -66,14 +110,10 @@ def process_dataframe(df):
         {'mask_notna': ['Column3', 'Column4', 'Column7', 'Column8'], 'mask_na': ['Column5'], 'shifted_col': df.loc[:, 'Column6':'Column12'].columns, 'shifted_periods': -1},
         {'mask_notna': ['Column3', 'Column4'], 'mask_na': ['Column5', 'Column6'], 'shifted_col': df.loc[:, 'Column5':'Column12'].columns, 'shifted_periods': -1},]
 
-    for process_dict in processing_list1:
-        df = filtering_df(df, process_dict)
-
+    # the first steps never move Column3, so the balance / interest rows can be dropped before shifting the rows
     df = df.loc[~df['Column3'].str.contains('Solde au', na=False)]
     df = df.loc[~df['Column3'].str.contains('Intérêt créditeur', na=False)]
-
-    for process_dict in processing_list2:
-        df = filtering_df(df, process_dict)
+    df = shift_rows(df, processing_list1 + processing_list2)
 
     mask12 = (df.loc[:, ['Column3', 'Column4', 'Column5']].notna().all(axis=1)) & (df['Column5'].astype(str).str.count(r'\.') == 2)
     df.loc[mask12, 'Column3'] = df.loc[mask12, 'Column3'] + ' ' + df.loc[mask12, 'Column4']
@@ -81,11 +121,6 @@ def process_dataframe(df):
     return df
 
 
-def extract_datetime(text):
-    match = re.search(r"\b\d{2}\.\d{2}\.\d{4} \d{2}:\d{2}\b", text)
-    return match.group(0) if match else None
-
-
 def cleaning_data(df):
     df = df[(df['Column4'].astype(str).str.count(r'\.') == 2) & (df['Column4'].str.len()==8)]
 
@@ -96,8 +131,8 @@ def cleaning_data(df):
     df[['out', 'in', 'balance']] = df[['out', 'in', 'balance']].fillna(0).astype(str).replace("'", "", regex=True).astype(float)
     df['out'] = -df['out']
 
-    temp_date = df['description'].apply(extract_datetime)
-    temp_date = pd.to_datetime(temp_date, format='%d.%m.%Y %H:%M')
+    temp_date = df['description'].str.extract(r"\b(\d{2}\.\d{2}\.\d{4} \d{2}:\d{2})\b", expand=False) # first booking time of the description
+    temp_date = parse_dates(temp_date, '%d.%m.%Y %H:%M')
     df['date'] = temp_date.fillna(df['date'])
 
     df['description'] = df['description'].str.lstrip()
@@ -160,7 +195,7 @@ def cash_flow_prep(df):
 
 
 
-def main():
+def main(since=None):
     df = loading_and_preclean_data()
     df = process_dataframe(df)
     df = cleaning_data(df)
@@ -168,7 +203,4 @@ def main():
 
     cash_flows = collection_config(dataframe=cash_flow_prep(df), collection_name='collection_cash_flows')
     dfs_list = [cash_flows]
-    return dfs_list
-
-
-z = main()
+    return filter_since(dfs_list, since)
@@ -2,10 +2,13 @@ import os
 import pandas as pd
 
 from src.plutus_lens.data import collection_config
+from src.plutus_lens.data.platform_data._data_extract_util import filter_since, read_workbook
+from src.plutus_lens.data.platform_data._parse_cache import cached_read
 
 
 RAW_DATA_PATH = os.environ.get("capital_tracker_raw_data")
 DATA_PATH = f'{RAW_DATA_PATH}/etoro/account_statement_data/'
+ACCOUNT_ACTIVITY_COLUMNS = ['Date', 'Type', 'Details', 'Amount', 'Units', 'Asset type']
 TICKERS_CORR_PATH = r'C:/Users/const/Documents/Code/Python/PlutusForge/plutus-lens/src/plutus_lens/services/ticker_corr.xlsx'
 
 
@@ -32,7 +35,8 @@ class EtoroData:
 
         account_statements_list = os.listdir(self.data_path)
         account_statements_list_filtered = list(filter(lambda x: '.xlsx' in x, account_statements_list))
-        account_statements_files = [pd.read_excel(self.data_path + file, sheet_name='Account Activity') for file in account_statements_list_filtered]
+        account_statements_files = [cached_read(self.data_path + file, read_workbook, sheets={'Account Activity': ACCOUNT_ACTIVITY_COLUMNS})['Account Activity']
+                                    for file in account_statements_list_filtered]
 
         account_activity_df = pd.concat(account_statements_files, ignore_index=True)
         account_activity_df['Date'] = pd.to_datetime(account_activity_df['Date'], dayfirst=True)
@@ -89,6 +93,9 @@ class EtoroData:
     def stock_split_corr(self, securities_ledger):
         ''' Adds simulated quantity to a stock following a stock split to adjust the owned quantity.
 
+        The owned quantity at each split is read as-of the split date from the cumulative units per ticker (one sort
+        and merge, whatever the number of splits and the history length).
+
         Parameters
         ----------
         securities_ledger : DataFrame
@@ -96,18 +103,34 @@ class EtoroData:
 
         '''
 
-        split_events_raw = self.account_activity_df.loc[self.account_activity_df['Type'] == 'corp action: Split'].copy()
-        split_events = split_events_raw[['Date', 'Details', 'Asset type']]
-        split_events.loc[:, ('ticker', 'splitter')] = split_events['Details'].str.split(' ', expand=True).values
-        splits_adj = pd.DataFrame(columns=['date', 'type', 'units', 'platform', 'ticker', 'quote_currency', 'asset_class'], dtype='object')
-        for idx, split in split_events.iterrows():
-            ticker = split['ticker'].split('/')[0]
-            owned_qt = securities_ledger.loc[(securities_ledger['date']<=split['Date']) & (securities_ledger['ticker'] == ticker)]['units']
-            if sum(owned_qt) != 0:
-                adjustment = sum(owned_qt) * int(split['splitter'].split(':')[0]) / int(split['splitter'].split(':')[1])
-                adjustment -= sum(owned_qt) # this qt is already owned, no need to adjust for this
-                adjusted_row = {'date':split['Date'], 'type':'split adjustment', 'units':adjustment, 'platform':'Etoro', 'ticker':ticker, 'quote_currency':split['ticker'].split('/')[1], 'asset_class':'Equity'}
-                splits_adj.loc[len(splits_adj)] = adjusted_row
+        adjustment_columns = ['date', 'type', 'units', 'platform', 'ticker', 'quote_currency', 'asset_class']
+        split_events = self.account_activity_df.loc[self.account_activity_df['Type'] == 'corp action: Split', ['Date', 'Details']]
+        if split_events.empty:
+            return pd.DataFrame(columns=adjustment_columns, dtype='object', index=pd.RangeIndex(len(securities_ledger), len(securities_ledger)))
+
+        details = split_events['Details'].str.split(' ', expand=True)
+        instrument = details[0].str.split('/', expand=True)
+        splitter = details[1].str.split(':', expand=True).astype(int)
+        splits = pd.DataFrame({'date': split_events['Date'], 'ticker': instrument[0], 'quote_currency': instrument[1],
+                               'ratio_numerator': splitter[0], 'ratio_denominator': splitter[1]})
+        splits['event_order'] = range(len(splits))
+
+        holdings = securities_ledger[['date', 'ticker', 'units']].sort_values('date', kind='mergesort')
+        holdings['owned_units'] = holdings.groupby('ticker')['units'].cumsum()
+        splits = pd.merge_asof(splits.sort_values('date', kind='mergesort'), holdings[['date', 'ticker', 'owned_units']],
+                               on='date', by='ticker', direction='backward') # last cumulative units dated on or before the split
+        splits = splits.loc[splits['owned_units'].fillna(0) != 0].sort_values('event_order')
+
+        owned_units = splits['owned_units']
+        splits_adj = pd.DataFrame({
+            'date': splits['date'],
+            'type': 'split adjustment',
+            'units': owned_units * splits['ratio_numerator'] / splits['ratio_denominator'] - owned_units, # the owned qt needs no adjustment
+            'platform': 'Etoro',
+            'ticker': splits['ticker'],
+            'quote_currency': splits['quote_currency'],
+            'asset_class': 'Equity',
+        }, columns=adjustment_columns)
         splits_adj.index = range(len(securities_ledger), len(securities_ledger)+len(splits_adj))
         return splits_adj
 
@@ -168,7 +191,7 @@ class EtoroData:
 
 
 
-def main():
+def main(since=None):
     etoro_data_object = EtoroData(DATA_PATH)
 
     secu_ledger = etoro_data_object.secu_ledger
@@ -183,7 +206,7 @@ def main():
     dividends = collection_config(dataframe=etoro_data_object.dividends_prep(), collection_name='collection_cash_flows')
 
     dfs_list = [cash_flows, cash_balanc, securities_ledger, dividends]
-    return dfs_list
+    return filter_since(dfs_list, since)
 
 
 
@@ -1,18 +1,31 @@
 import os
 
 import pandas as pd
-from datetime import datetime
 
 from src.plutus_lens.data import collection_config
+from src.plutus_lens.data.platform_data._data_extract_util import filter_since, parse_dates, read_workbook
+from src.plutus_lens.data.platform_data._parse_cache import cached_read
 
 
 RAW_DATA_PATH = os.environ.get("capital_tracker_raw_data")
 DATA_PATH = f'{RAW_DATA_PATH}/ibkr/ibkr_data.xlsx'
+WORKBOOK_SHEETS = {
+    'cash_flows': ['Currency', 'Settle Date', 'Description', 'Amount'],
+    'ibkr_secu_flow': ['Date/Time', 'Symbol', 'Quantity', 'Currency', 'Asset Category', 'Comm/Fee', 'T. Price', 'Proceeds'],
+    'ibkr_dividends': ['Date', 'Amount', 'Currency', 'Description'],
+}
 
 
 
 
-def cash_flow_prep(path):
+def load_workbook(path):
+    ''' Reads the used columns of all the IBKR sheets in a single pass (through the parse cache). '''
+
+    return cached_read(path, read_workbook, sheets=WORKBOOK_SHEETS)
+
+
+
+def cash_flow_prep(data):
     ''' Extract the cash flows positions from account activity data and returns a cleaned df.
 
     Returns
@@ -22,7 +35,6 @@ def cash_flow_prep(path):
 
     '''
 
-    data = pd.read_excel(path, sheet_name='cash_flows')
     data = data.loc[data['Currency'] != 'Total']
     data['Settle Date'] = pd.to_datetime(data['Settle Date'])
     data['platform'] = 'Interactive Brokers'
@@ -34,7 +46,7 @@ def cash_flow_prep(path):
 
 
 
-def securities_ledger_prep(path):
+def securities_ledger_prep(securities_transactions):
     ''' Extract the securities movements from account activity data and returns a cleaned df.
 
     Returns
@@ -44,11 +56,9 @@ def securities_ledger_prep(path):
 
     '''
 
-    securities_transactions = pd.read_excel(path, sheet_name='ibkr_secu_flow')
-
     secu_ledger = securities_transactions.loc[:, ('Date/Time', 'Symbol', 'Quantity', 'Currency', 'Asset Category', 'Comm/Fee', 'T. Price', 'Proceeds')].copy()
     secu_ledger.rename(columns={'Date/Time':'date', 'Symbol':'ticker', 'Quantity':'units', 'Currency':'quote_currency', 'Comm/Fee':'fees', 'T. Price':'amount', 'Asset Category':'asset_class'}, inplace=True)
-    secu_ledger['date'] = secu_ledger['date'].apply(lambda x: datetime.strptime(x, '%Y-%m-%d, %H:%M:%S'))
+    secu_ledger['date'] = parse_dates(secu_ledger['date'], '%Y-%m-%d, %H:%M:%S')
     secu_ledger['units'] = secu_ledger['units'].str.replace(',','').astype(float)
 
     secu_ledger.loc[:, 'platform'] = 'Interactive Brokers'
@@ -115,10 +125,9 @@ def cash_balancing(secu_ledger):
 
 
 
-def dividends_prep(path):
+def dividends_prep(dividends):
     ''' Creates an entry in the cash_flows collection for each dividend. '''
 
-    dividends = pd.read_excel(path, sheet_name='ibkr_dividends')
     dividends = dividends.loc[~dividends['Currency'].str.contains('Total'), ('Date', 'Amount', 'Currency', 'Description')]
     dividends.rename(columns={'Date':'date', 'Amount':'amount', 'Currency':'currency', 'Description':'description'}, inplace=True)
 
@@ -133,20 +142,21 @@ def dividends_prep(path):
 
 
 
-def main():
-    secu_ledger = securities_ledger_prep(DATA_PATH)
+def main(since=None):
+    workbook = load_workbook(DATA_PATH)
+    secu_ledger = securities_ledger_prep(workbook['ibkr_secu_flow'])
     secu_ledger_filtered = secu_ledger.loc[secu_ledger['asset_class']=='Equity']
 
-    cash_flows = collection_config(dataframe=cash_flow_prep(DATA_PATH), collection_name='collection_cash_flows')
+    cash_flows = collection_config(dataframe=cash_flow_prep(workbook['cash_flows']), collection_name='collection_cash_flows')
     fx_transactions = collection_config(dataframe=fx_balancing(secu_ledger), collection_name='collection_cash_flows')
     securities_ledger = collection_config(
         dataframe=secu_ledger_filtered[['date', 'type', 'units', 'platform', 'ticker', 'quote_currency', 'asset_class', 'fees', 'amount']],
         collection_name='collection_securities_ledger', amount_col='units', ccy_col='quote_currency')
     cash_balanc = collection_config(dataframe=cash_balancing(secu_ledger_filtered), collection_name='collection_cash_flows')
-    dividends = collection_config(dataframe=dividends_prep(DATA_PATH), collection_name='collection_cash_flows')
+    dividends = collection_config(dataframe=dividends_prep(workbook['ibkr_dividends']), collection_name='collection_cash_flows')
 
     dfs_list = [cash_flows, fx_transactions, securities_ledger, cash_balanc, dividends]
-    return dfs_list
+    return filter_since(dfs_list, since)
 
 
 
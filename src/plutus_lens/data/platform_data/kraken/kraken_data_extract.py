@@ -1,25 +1,105 @@
 import os
 import time
 import json
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 import urllib.parse
 import hashlib
 import hmac
 import base64
 
 from src.plutus_lens.data import collection_config
+from src.plutus_lens.data.platform_data._data_extract_util import filter_since
+from src.plutus_lens.data.platform_data.kraken.kraken_ledger_journal import KrakenLedgerJournal
 
 
 
+KRAKEN_URL = os.environ.get('capital_tracker_kraken_url', 'https://api.kraken.com') # a local stand-in server can be set for tests
+LEDGER_PATH = '/0/private/Ledgers'
+LEDGER_PAGE_SIZE = 50 # number of ledger entries returned by the API per call
+LEDGER_CALL_COST = 2 # call counter increase of a ledger query
+MAX_CONCURRENT_PAGES = 3
+KRAKEN_OFFLINE = os.environ.get('capital_tracker_kraken_offline', 'False') == 'True' # processes the local journal without calling the API
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+TRANSIENT_ERRORS = ('EAPI:Rate limit exceeded', 'EAPI:Invalid nonce', 'EService:Unavailable', 'EService:Busy', 'EGeneral:Temporary lockout')
+
+
+
+class CallRateLimiter:
+    ''' Client side copy of the Kraken API call counter, blocking the calls that would exceed it.
+
+    Each private call increases the counter by its cost, and the counter decays by decay_rate per second. The defaults
+    are the starter tier limits (15 and 0.33/s), intermediate / pro accounts can use (20, 0.5) / (20, 1). The API
+    counts a call when it receives it: latency (seconds) is kept as a margin, so that a call sent right after a
+    faster one is not counted before the counter has decayed enough.
+    '''
+
+    def __init__(self, max_counter=15, decay_rate=0.33, latency=0.1):
+        self.max_counter = max_counter
+        self.decay_rate = decay_rate
+        self.latency = latency
+        self.__counter = 0.0
+        self.__last_update = time.monotonic()
+        self.__lock = threading.Lock()
+
+
+    def acquire(self, cost=1):
+        with self.__lock:
+            while True:
+                now = time.monotonic()
+                self.__counter = max(0.0, self.__counter - (now - self.__last_update) * self.decay_rate)
+                self.__last_update = now
+                margin = self.latency * self.decay_rate
+                if self.__counter + cost + margin <= self.max_counter:
+                    self.__counter += cost
+                    return
+                time.sleep((self.__counter + cost + margin - self.max_counter) / self.decay_rate)
+
 
 
-class KrakenAPI:
 
-    def __init__(self):
+class KrakenAPI:
+    ''' Kraken private API client, sharing one keep-alive session, call counter and nonce sequence between threads.
+
+    The nonces are strictly increasing, but concurrent calls can still reach the API out of order: the calls rejected
+    with an invalid nonce (as the rate limited or unavailable ones and the connection errors) are retried with a new
+    nonce and an exponential backoff. A nonce window on the API key avoids most of these retries.
+
+    Attributes
+    ----------
+    base_url : str, optional
+        API root URL, KRAKEN_URL if not specified.
+    rate_limiter : CallRateLimiter, optional
+        Call counter shared by the calls, starter tier limits if not specified.
+    max_retries : int, optional
+        Number of retries of a failing call (default is 5).
+    backoff : float, optional
+        Delay before the first retry in seconds, doubled at each retry (default is 1).
+    timeout : float, optional
+        Connection / read timeout of a call in seconds (default is 30).
+    '''
+
+    def __init__(self, base_url=None, rate_limiter=None, max_retries=5, backoff=1.0, timeout=30):
         self.__api_key = os.environ.get('capital_tracker_kraken_key')
         self.__api_sec = os.environ.get('capital_tracker_kraken_sec')
+        self.base_url = (base_url or KRAKEN_URL).rstrip('/')
+        self.rate_limiter = rate_limiter or CallRateLimiter()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENT_PAGES)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.__nonce_lock = threading.Lock()
+        self.__last_nonce = 0
 
 
     def get_kraken_signature(self, urlpath, data, secret):
@@ -34,52 +114,136 @@ class KrakenAPI:
         return sigdigest.decode()
 
 
-    def kraken_api_prompt(self, url, data_offset):
-        payload = json.dumps({
-            'nonce': str(int(time.time()*1000)),
-            'ofs':data_offset
-        })
-        sign_url = url.split('https://api.kraken.com')[-1]
-        headers = {
-          'Content-Type': 'application/json',
-          'Accept': 'application/json',
-          'API-Key': self.__api_key,
-          'API-Sign': self.get_kraken_signature(sign_url, payload, self.__api_sec)
-        }
-        response = requests.request("POST", url, headers=headers, data=payload)
-        return response.json()
+    def next_nonce(self):
+        ''' Returns a nonce (milliseconds timestamp) strictly greater than the previous ones, even within the same millisecond. '''
 
+        with self.__nonce_lock:
+            self.__last_nonce = max(int(time.time()*1000), self.__last_nonce + 1)
+            return self.__last_nonce
 
 
+    def kraken_api_prompt(self, path, parameters, cost=1):
+        ''' Calls a private endpoint (ex: LEDGER_PATH) and returns its result, retrying the transient failures.
 
-def get_kraken_ledger_data(api_object, url, data_offset):
-    kraken_ledger = api_object.kraken_api_prompt(url, data_offset)
-    kraken_ledger_subset_df = pd.DataFrame(kraken_ledger['result']['ledger'].values())
-    return kraken_ledger_subset_df
+        Raises a RuntimeError on an API error that is not transient, or once the retries are exhausted.
+        '''
+
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2**(attempt - 1))
+            self.rate_limiter.acquire(cost)
+            payload = json.dumps({'nonce': str(self.next_nonce()), **parameters})
+            headers = {
+              'Content-Type': 'application/json',
+              'Accept': 'application/json',
+              'API-Key': self.__api_key,
+              'API-Sign': self.get_kraken_signature(path, payload, self.__api_sec)
+            }
+            try:
+                response = self.session.post(self.base_url + path, headers=headers, data=payload, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                last_error = error
+                continue
+
+            if response.status_code in RETRY_STATUSES:
+                last_error = requests.HTTPError(f'{response.status_code} Server Error for url: {response.url}', response=response)
+                continue
+            response.raise_for_status()
+            kraken_response = response.json()
+            errors = kraken_response.get('error') or []
+            if not errors:
+                return kraken_response['result']
+            if not all(error.startswith(TRANSIENT_ERRORS) for error in errors):
+                raise RuntimeError(f'Kraken API error on {path}: {errors}')
+            last_error = RuntimeError(f'Kraken API error on {path}: {errors}')
 
+        raise RuntimeError(f'Kraken API call to {path} failed after {self.max_retries} retries: {last_error!r}') from last_error
 
 
-def get_full_kraken_ledger():
-    api_object = KrakenAPI()
-    url = 'https://api.kraken.com/0/private/Ledgers'
 
-    kraken_ledger = api_object.kraken_api_prompt(url, 0)
-    kraken_ledger_list = [pd.DataFrame(kraken_ledger['result']['ledger'].values())]
 
-    ledger_size = kraken_ledger['result']['count']
-    ledger_size -= 50
-    data_offset = 50
-    while ledger_size > 0:
-        temp_ledger = get_kraken_ledger_data(api_object, url, data_offset)
-        kraken_ledger_list.append(temp_ledger)
-        ledger_size -= 50
-        data_offset += 50
+def get_kraken_ledger_result(api_object, data_offset, start=None, end=None):
+    ''' Returns the ledger page at data_offset (ledger entries by ID and count), within the start (exclusive) and end
+    (inclusive, unix timestamp or ledger ID) bounds. '''
 
-    kraken_ledger_df = pd.concat(kraken_ledger_list)
+    parameters = {'ofs': data_offset}
+    if start is not None:
+        parameters['start'] = start
+    if end is not None:
+        parameters['end'] = end
+    return api_object.kraken_api_prompt(LEDGER_PATH, parameters, cost=LEDGER_CALL_COST)
+
+
+
+def get_kraken_ledger_data(api_object, data_offset, start=None, end=None):
+    kraken_ledger = get_kraken_ledger_result(api_object, data_offset, start, end)
+    kraken_ledger_subset_df = pd.DataFrame.from_dict(kraken_ledger['ledger'], orient='index') # indexed by ledger ID
+    return kraken_ledger_subset_df
+
+
+
+def iter_kraken_ledger_pages(start=None, end=None, api_object=None, max_workers=MAX_CONCURRENT_PAGES):
+    ''' Yields the ledger one API page at a time, from the oldest page to the newest one.
+
+    The API pages from the newest entry (offset 0), so the first call gives the ledger size and the newest page, which is
+    yielded last. All the other offsets are then known: they are requested concurrently (at most max_workers pages in
+    flight, within the call counter limits) up to the newest entry ID, so that the entries booked in the meantime do
+    not shift the offsets.
+
+    Parameters
+    ----------
+    start : int, optional
+        Exclusive unix timestamp, only the ledger entries after it are returned.
+    end : int or str, optional
+        Inclusive unix timestamp or ledger ID, only the ledger entries up to it are returned.
+    api_object : KrakenAPI, optional
+        API client, a new one if not specified.
+    max_workers : int, optional
+        Maximum number of pages requested concurrently (default is MAX_CONCURRENT_PAGES).
+    '''
+
+    api_object = api_object or KrakenAPI()
+    newest_ledger = get_kraken_ledger_result(api_object, 0, start, end)
+    newest_page = pd.DataFrame.from_dict(newest_ledger['ledger'], orient='index')
+
+    if newest_ledger['count'] > LEDGER_PAGE_SIZE:
+        end = max(newest_ledger['ledger'], key=lambda ledger_id: float(newest_ledger['ledger'][ledger_id]['time']))
+        last_offset = (newest_ledger['count'] - 1) // LEDGER_PAGE_SIZE * LEDGER_PAGE_SIZE
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            pages = deque()
+            for data_offset in range(last_offset, 0, -LEDGER_PAGE_SIZE):
+                pages.append(pool.submit(get_kraken_ledger_data, api_object, data_offset, start, end))
+                if len(pages) >= max_workers:
+                    yield pages.popleft().result()
+            while pages:
+                yield pages.popleft().result()
+    yield newest_page
+
+
+
+def get_full_kraken_ledger(start=None, end=None):
+    kraken_ledger_df = pd.concat(list(iter_kraken_ledger_pages(start=start, end=end)))
     return kraken_ledger_df
 
 
 
+def refresh_ledger_journal(journal, api_object=None):
+    ''' Downloads the ledger entries booked after the last journaled one and appends them to the journal, page by page.
+
+    Returns
+    -------
+    int
+        Number of new ledger entries.
+    '''
+
+    new_entries = 0
+    for kraken_ledger_df in iter_kraken_ledger_pages(start=journal.resume_start(), api_object=api_object):
+        new_entries += journal.merge(kraken_ledger_df)
+    return new_entries
+
+
+
 
 def clean_ledger(kraken_ledger_df):
     kraken_ledger_df['time'] = pd.to_datetime(kraken_ledger_df['time'], unit='s', utc=True)
@@ -101,10 +265,37 @@ def clean_ledger(kraken_ledger_df):
 
 
 
-def main():
-    kraken_ledger_df = get_full_kraken_ledger()
+def ledger_start(since=None):
+    return int(pd.Timestamp(since).timestamp()) - 1 if since is not None else None # exclusive journal start, since is inclusive
+
+
+
+def main(since=None, offline=None):
+    journal = KrakenLedgerJournal()
+    if not (KRAKEN_OFFLINE if offline is None else offline):
+        refresh_ledger_journal(journal)
+
+    kraken_ledger_df = journal.read(start=ledger_start(since))
+    if kraken_ledger_df.empty:
+        return [] # no ledger entry since then
     kraken_ledger_df = clean_ledger(kraken_ledger_df)
 
     cryptos = collection_config(dataframe=kraken_ledger_df, collection_name='collection_cryptos', amount_col='units')
-    return [cryptos]
-z = main()
+    return filter_since([cryptos], since)
+
+
+
+def stream(since=None, offline=None):
+    ''' Streaming version of main, yields the cryptos collection by chunks of journaled ledger entries (oldest first).
+
+    The new API pages are first merged into the local journal (see refresh_ledger_journal), then the journal is read
+    back in fixed-size chunks of at most 1000 entries (KrakenLedgerJournal.iter_frames), not one chunk per API page.
+    '''
+
+    journal = KrakenLedgerJournal()
+    if not (KRAKEN_OFFLINE if offline is None else offline):
+        refresh_ledger_journal(journal)
+
+    for kraken_ledger_df in journal.iter_frames(start=ledger_start(since)):
+        cryptos = collection_config(dataframe=clean_ledger(kraken_ledger_df), collection_name='collection_cryptos', amount_col='units')
+        yield filter_since([cryptos], since)
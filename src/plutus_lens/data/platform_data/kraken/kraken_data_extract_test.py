@@ -0,0 +1,150 @@
+''' Checks the Kraken ledger fetcher against a local stand-in of the private Ledgers endpoint (paging, nonce ordering,
+call counter and journal refreshes), run with pytest from the repository root. '''
+
+import json
+import time
+import base64
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pandas as pd
+import pytest
+
+from src.plutus_lens.data.platform_data.kraken import kraken_data_extract
+from src.plutus_lens.data.platform_data.kraken.kraken_data_extract import CallRateLimiter, KrakenAPI, LEDGER_PAGE_SIZE, iter_kraken_ledger_pages, refresh_ledger_journal
+from src.plutus_lens.data.platform_data.kraken.kraken_ledger_journal import KrakenLedgerJournal
+
+
+FIRST_TIME = 1.7e9
+MAX_COUNTER, DECAY_RATE = 6, 10 # fast decaying call counter, so that the test runs in a few seconds
+
+
+
+
+def ledger_entries(first, last):
+    return {f'L{idx:05d}': {'refid': f'R{idx:05d}', 'time': FIRST_TIME + idx*60 + 0.5, 'type': 'trade', 'subtype': '', 'aclass': 'currency',
+                            'asset': 'XETH', 'amount': '0.1000', 'fee': '0.0001', 'balance': '1.0000'} for idx in range(first, last)}
+
+
+
+class KrakenStandIn(ThreadingHTTPServer):
+    ''' Stand-in of the Kraken Ledgers endpoint: pages of 50 entries from the newest one, start (exclusive) and end
+    (inclusive, timestamp or ledger ID) bounds, invalid nonce errors on the non increasing nonces and rate limit
+    errors when the call counter (cost 2 per ledger call) would exceed MAX_COUNTER. Every 7th call fails with a 503. '''
+
+    def __init__(self, ledger):
+        super().__init__(('127.0.0.1', 0), LedgerHandler)
+        self.ledger = ledger
+        self.lock = threading.Lock()
+        self.requests = [] # parameters of the served calls
+        self.nonce_errors = self.rate_limit_errors = self.calls = 0
+        self.last_nonce = 0
+        self.counter, self.last_update = 0.0, time.monotonic()
+
+
+    def answer(self, parameters):
+        with self.lock:
+            self.calls += 1
+            if self.calls % 7 == 0:
+                return 503, None
+            now = time.monotonic()
+            self.counter = max(0.0, self.counter - (now - self.last_update) * DECAY_RATE)
+            self.last_update = now
+            if self.counter + 2 > MAX_COUNTER + 1e-6:
+                self.rate_limit_errors += 1
+                return 200, {'error': ['EAPI:Rate limit exceeded'], 'result': {}}
+            self.counter += 2
+            if int(parameters['nonce']) <= self.last_nonce:
+                self.nonce_errors += 1
+                return 200, {'error': ['EAPI:Invalid nonce'], 'result': {}}
+            self.last_nonce = int(parameters['nonce'])
+            self.requests.append(parameters)
+
+            entries = sorted(self.ledger.items(), key=lambda item: -item[1]['time'])
+            if 'start' in parameters:
+                entries = [(ledger_id, entry) for ledger_id, entry in entries if entry['time'] > parameters['start']]
+            if 'end' in parameters:
+                end = self.ledger[parameters['end']]['time'] if isinstance(parameters['end'], str) else parameters['end']
+                entries = [(ledger_id, entry) for ledger_id, entry in entries if entry['time'] <= end]
+            page = dict(entries[parameters['ofs']:parameters['ofs'] + LEDGER_PAGE_SIZE])
+            return 200, {'error': [], 'result': {'ledger': page, 'count': len(entries)}}
+
+
+
+class LedgerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, as the Kraken API
+
+    def log_message(self, *args):
+        pass
+
+
+    def do_POST(self):
+        parameters = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        status, body = self.server.answer(parameters)
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+
+
+@pytest.fixture
+def stand_in(monkeypatch):
+    monkeypatch.setenv('capital_tracker_kraken_key', 'key')
+    monkeypatch.setenv('capital_tracker_kraken_sec', base64.b64encode(b'secret').decode())
+    server = KrakenStandIn(ledger_entries(0, 237))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(kraken_data_extract, 'KRAKEN_URL', f'http://127.0.0.1:{server.server_port}')
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def stand_in_api():
+    return KrakenAPI(rate_limiter=CallRateLimiter(MAX_COUNTER, DECAY_RATE), backoff=0.01)
+
+
+def test_ledger_pages(stand_in):
+    pages = list(iter_kraken_ledger_pages(api_object=stand_in_api()))
+    ledger_df = pd.concat(pages)
+
+    assert sorted(ledger_df.index) == sorted(stand_in.ledger)
+    assert [page['time'].max() for page in pages] == sorted(page['time'].max() for page in pages) # oldest page first
+    assert sorted(parameters['ofs'] for parameters in stand_in.requests) == list(range(0, 237, LEDGER_PAGE_SIZE))
+    assert all(parameters['end'] == 'L00236' for parameters in stand_in.requests if parameters['ofs']) # offsets pinned to the newest entry
+    assert stand_in.rate_limit_errors == 0 # the client side call counter matches the API one
+
+
+def test_nonce_ordering(stand_in):
+    api = stand_in_api()
+    nonces = []
+    threads = [threading.Thread(target=lambda: nonces.extend(api.next_nonce() for _ in range(200))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(nonces)) == len(nonces) # unique across threads, even within the same millisecond
+
+    pages = list(iter_kraken_ledger_pages(api_object=api))
+    assert sum(len(page) for page in pages) == 237 # the calls rejected for their nonce (or a 503) are retried
+    served_nonces = [int(parameters['nonce']) for parameters in stand_in.requests]
+    assert served_nonces == sorted(served_nonces) and len(set(served_nonces)) == len(served_nonces)
+
+
+def test_incremental_journal(stand_in, tmp_path):
+    journal = KrakenLedgerJournal(path=str(tmp_path / 'kraken_ledger_journal.jsonl'))
+    assert refresh_ledger_journal(journal, api_object=stand_in_api()) == 237
+
+    stand_in.ledger.update(ledger_entries(237, 301))
+    stand_in.requests.clear()
+    assert refresh_ledger_journal(journal, api_object=stand_in_api()) == 64
+    assert all(parameters['start'] == int(FIRST_TIME + 236*60 + 0.5) - 1 for parameters in stand_in.requests) # new entries only
+    assert len(stand_in.requests) == 2
+
+    assert refresh_ledger_journal(journal, api_object=stand_in_api()) == 0 # the overlap second is not journaled twice
+    journal_df = KrakenLedgerJournal(path=journal.path).read()
+    assert sorted(journal_df.index) == sorted(stand_in.ledger)
+    assert journal_df['time'].is_monotonic_increasing
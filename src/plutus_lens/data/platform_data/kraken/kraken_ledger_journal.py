@@ -0,0 +1,106 @@
+''' Local append-only journal of the raw Kraken ledger entries (JSON lines keyed by ledger ID): the closed ledger
+entries never change, so a refresh only has to download the entries booked after the last journaled one. '''
+
+import os
+import json
+
+import pandas as pd
+
+
+RAW_DATA_PATH = os.environ.get("capital_tracker_raw_data")
+JOURNAL_PATH = f'{RAW_DATA_PATH}/kraken/kraken_ledger_journal.jsonl'
+
+
+
+
+class KrakenLedgerJournal:
+    ''' Class meant to read / append the raw ledger entries journal.
+
+    Each line holds one raw ledger entry as returned by the API (time, asset, amount, fee, ...) with its ledger_id. The
+    entries are appended in chronological order, so the journal can be read back in chronological chunks.
+
+    Attributes
+    ----------
+    path : str, optional
+        Path of the journal file, JOURNAL_PATH if not specified.
+    ledger_ids : set
+        IDs of the journaled entries.
+    last_time : float
+        Unix time of the newest journaled entry (None if the journal is empty).
+    '''
+
+    def __init__(self, path=None):
+        self.path = path or JOURNAL_PATH
+        self.ledger_ids = set()
+        self.last_time = None
+        for entries in self.__iter_entries():
+            self.ledger_ids.update(entry['ledger_id'] for entry in entries)
+            self.last_time = max([self.last_time or 0.0] + [float(entry['time']) for entry in entries])
+
+
+    def __iter_entries(self, chunk_size=1000):
+        ''' Yields the journaled entries by lists of chunk_size (a truncated last line, left by an interrupted append, is skipped). '''
+
+        if not os.path.isfile(self.path):
+            return
+        entries = []
+        with open(self.path, encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+                if len(entries) >= chunk_size:
+                    yield entries
+                    entries = []
+        if entries:
+            yield entries
+
+
+    def resume_start(self):
+        ''' Exclusive start timestamp of the next API refresh (one second of overlap, the entries already journaled are dropped by merge). '''
+
+        return int(self.last_time) - 1 if self.last_time is not None else None
+
+
+    def merge(self, ledger_page):
+        ''' Appends the entries of a raw ledger page (DataFrame indexed by ledger ID) that are not journaled yet.
+
+        Returns
+        -------
+        int
+            Number of entries appended.
+        '''
+
+        new_entries = ledger_page.loc[~ledger_page.index.isin(self.ledger_ids) & ~ledger_page.index.duplicated()]
+        if new_entries.empty:
+            return 0
+        new_entries = new_entries.sort_values('time')
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as journal_file:
+            for ledger_id, entry in zip(new_entries.index, new_entries.to_dict('records')):
+                journal_file.write(json.dumps({'ledger_id': ledger_id, **entry}) + '\n')
+
+        self.ledger_ids.update(new_entries.index)
+        self.last_time = max(self.last_time or 0.0, float(new_entries['time'].astype(float).max()))
+        return len(new_entries)
+
+
+    def iter_frames(self, start=None, chunk_size=1000):
+        ''' Yields the journaled entries dated after start (exclusive unix timestamp), by DataFrames (indexed by ledger
+        ID) of at most chunk_size entries, in chronological order. '''
+
+        for entries in self.__iter_entries(chunk_size):
+            ledger_frame = pd.DataFrame(entries).set_index('ledger_id')
+            if start is not None:
+                ledger_frame = ledger_frame.loc[ledger_frame['time'].astype(float) > start]
+            if not ledger_frame.empty:
+                yield ledger_frame
+
+
+    def read(self, start=None):
+        ''' Returns the journaled entries dated after start (exclusive unix timestamp) in a DataFrame indexed by ledger ID. '''
+
+        ledger_frames = list(self.iter_frames(start))
+        return pd.concat(ledger_frames) if ledger_frames else pd.DataFrame()
@@ -1,16 +1,53 @@
-import importlib
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import numpy as np
 import pandas as pd
 
-from src.plutus_lens.data import CollectionConnect
+from src.plutus_lens.data import CollectionConnect, ensure_collection_indexes, index_usage_report
+from src.plutus_lens.data.platform_data._ingestion_watermarks import IngestionWatermarks
+from src.plutus_lens.data.platform_data._platform_registry import discover_platforms, load_platform
+
+
+PLATFORMS = discover_platforms() # the extract modules themselves are only imported when a platform is refreshed
+EXECUTORS = {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}
+
+
+
+
+def extract_platform(platform, since=None):
+    ''' Runs the data extract of a platform (module level function so that it can be sent to a process pool). '''
+
+    return load_platform(platform).main(since=since)
+
+
+
+def stream_platform(platform, since=None):
+    ''' Yields the data extract of a platform chunk by chunk (each chunk being a list of collection configs).
+
+    Platforms exposing a stream(since=None) generator (ex: kraken, fixed-size chunks read back from its ledger journal)
+    emit bounded chunks, in chronological order. The other platforms emit their whole main() output as a single chunk.
+    '''
 
+    platform_module = load_platform(platform)
+    if hasattr(platform_module, 'stream'):
+        yield from platform_module.stream(since=since)
+    else:
+        yield platform_module.main(since=since)
 
-PLATFORMS = ['bcge', 'etoro', 'ibkr', 'kraken', 'revolut']
-PLATFORMS_MODULES = {}
 
-for platform in PLATFORMS:
-    PLATFORMS_MODULES[platform] = importlib.import_module(f'src.plutus_lens.data.platform_data.{platform}.{platform}_data_extract')
 
+def _put_until_stopped(chunks, item, stop):
+    ''' Puts an item into the bounded chunks queue, gives up (returns False) once the consumer has stopped. '''
 
+    while not stop.is_set():
+        try:
+            chunks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
 
 
 
@@ -35,7 +72,125 @@ def generate_id_col(time_col, *args):
 
 
 
-def balance_calc(df, amount_col='amount', ccy_col='currency'):
+def epoch_seconds(time_col):
+    ''' Vectorized equivalent of int(timestamp.timestamp()) over a datetime column (naive datetimes are read as UTC, as pandas does).
+
+    Parameters
+    ----------
+    time_col : pandas.Series
+        Datetime column (datetime64, tz-aware or naive).
+
+    Returns
+    -------
+    numpy.ndarray
+        Seconds since epoch (int64), truncated as int() does on the Timestamp.timestamp() float (rounded to 6 decimals).
+    '''
+
+    time_col = pd.to_datetime(time_col)
+    if time_col.dt.tz is not None:
+        time_col = time_col.dt.tz_convert('UTC').dt.tz_localize(None)
+    nanoseconds = time_col.to_numpy('datetime64[ns]').view('int64')
+    return np.round(nanoseconds / 10**9, 6).astype('int64')
+
+
+
+def build_id_col(time_col, *columns):
+    ''' Vectorized equivalent of generate_id_col, working on whole columns instead of one row at a time.
+
+    Parameters
+    ----------
+    time_col : pandas.Series
+        Datetime column used for the timestamp part of the ID.
+    *columns : pandas.Series
+        Additional columns (categorical, numeric or text) to include in the ID, formatted with str() as generate_id_col does.
+
+    Returns
+    -------
+    pandas.Series
+        Unique identifiers in the format "{timestamp} - {col1} - {col2} - ...", identical to generate_id_col.
+    '''
+
+    ids = pd.Series(epoch_seconds(time_col).astype(str).astype(object), index=time_col.index)
+    for column in columns:
+        ids = ids + ' - ' + column.astype(object).map(str) # str() of the python values, as in generate_id_col (missing values give 'nan')
+    return ids
+
+
+
+def resumable_cumsum(values, categories, balances):
+    ''' Cumulative sum per category, identical to pandas groupby cumsum but resumable from a saved state.
+
+    pandas sums each group with Kahan compensation, so the state of a category is its (sum, compensation) pair: starting
+    from the closing state of a previous call gives exactly the same floats as a single call over the whole history.
+
+    Parameters
+    ----------
+    values : pandas.Series
+        Values to be summed (NaN values are skipped and give NaN, as in pandas).
+    categories : pandas.Series
+        Category of each value (None for the rows without category, that give NaN).
+    balances : dict
+        (sum, compensation) opening state per category, updated in place with the closing state.
+
+    Returns
+    -------
+    numpy.ndarray
+        Cumulative sums.
+    '''
+
+    output = np.empty(len(values))
+    state = {}
+    for idx, (value, category) in enumerate(zip(values.tolist(), categories.tolist())):
+        if category is None or value != value:
+            output[idx] = np.nan
+            continue
+        if category not in state:
+            state[category] = list(balances.get(category, (0.0, 0.0)))
+        accumulated, compensation = state[category]
+        compensated_value = value - compensation
+        total = accumulated + compensated_value
+        state[category] = [total, (total - accumulated) - compensated_value]
+        output[idx] = total
+    balances.update(state)
+    return output
+
+
+
+def balance_categories(df, ccy_col='currency'):
+    ''' Returns the '{currency} - {platform} - {type}' balance category of each row (None if any of them is missing). '''
+
+    categories = df[ccy_col].astype(str) + ' - ' + df['platform'].astype(str) + ' - ' + df['type'].astype(str)
+    return categories.astype(object).where(df[[ccy_col, 'platform', 'type']].notna().all(axis=1), None)
+
+
+
+def merge_collections(collection_list):
+    ''' Merges the collection configs going to the same destination with the same columns, keyed by
+    (platform, destination collection, amount column, currency column). '''
+
+    merged = {}
+    for collection in collection_list:
+        key = (collection['platform'], collection['destination_collection'], collection['amount_col'], collection['ccy_col'])
+        if key in merged:
+            collection = dict(collection, DataFrame=pd.concat([merged[key]['DataFrame'], collection['DataFrame']], ignore_index=True))
+        merged[key] = collection
+    return merged
+
+
+
+def day_opening_balances(df, day, amount_col='amount', ccy_col='currency', balances=None):
+    ''' Returns the running balances at the start of day: the opening balances plus the rows of df dated before day
+    (summed in the balance_calc order, so that a refresh resumed from day gives the same _id). '''
+
+    day_balances = {category: list(state) for category, state in (balances or {}).items()}
+    df = df.sort_values(by=['date', amount_col], ascending=[True, True])
+    df = df.loc[pd.to_datetime(df['date'], utc=True) < day]
+    resumable_cumsum(df[amount_col].abs(), balance_categories(df, ccy_col), day_balances)
+    return day_balances
+
+
+
+def balance_calc(df, amount_col='amount', ccy_col='currency', balances=None):
     ''' Calculate a cumulative balance grouped by categories and add a unique identifier column (_id, that will be used to write the data into MongoDB).
 
     Parameters
@@ -46,6 +201,10 @@ def balance_calc(df, amount_col='amount', ccy_col='currency'):
         The name of the column representing transaction amounts (default is 'amount').
     ccy_col : str, optional
         The name of the column representing currencies (default is 'currency').
+    balances : dict, optional
+        Running balances state per '{currency} - {platform} - {type}' category (see resumable_cumsum). If specified,
+        they are used as opening balances (so that a partial history continues the cumulative balances of the records
+        already written, with the same _id as a full history) and updated in place with the closing balances.
 
     Returns
     -------
@@ -56,11 +215,13 @@ def balance_calc(df, amount_col='amount', ccy_col='currency'):
         - '_id': A unique identifier generated for each row.
     '''
 
-    df = df.sort_values(by=['date', amount_col], ascending=[True, True]).copy()
-    df_temp = df.copy()
-    df_temp['amount_abs'] = abs(df_temp[amount_col])
-    df_temp['balance_by_cat'] = df_temp.groupby([ccy_col, 'platform', 'type'])['amount_abs'].cumsum()
-    df['_id'] = df_temp[['date', 'type', amount_col, ccy_col, 'platform', 'balance_by_cat']].apply(lambda row: generate_id_col(row['date'], *row[1:]), axis=1)
+    df = df.sort_values(by=['date', amount_col], ascending=[True, True]) # new frame, the input df is left untouched
+    amount_abs = df[amount_col].abs()
+    if balances is None:
+        balance_by_cat = amount_abs.groupby([df[ccy_col], df['platform'], df['type']], observed=True).cumsum()
+    else:
+        balance_by_cat = pd.Series(resumable_cumsum(amount_abs, balance_categories(df, ccy_col), balances), index=df.index)
+    df['_id'] = build_id_col(df['date'], df['type'], df[amount_col], df[ccy_col], df['platform'], balance_by_cat)
     return df
 
 
@@ -74,45 +235,205 @@ class CapitalVaultDataFeed:
 
     This class handles the extraction of data from various platforms, cleans and processes the data,
     and writes it to the appropriate MongoDB collections.
+
+    Attributes
+    ----------
+    platforms : list, optional
+        Platforms to be refreshed (ex: ['revolut']), all the discovered platforms if not specified.
     '''
 
-    def __init__(self):
-        self.platforms = PLATFORMS
+    def __init__(self, platforms=None):
+        self.platforms = list(platforms) if platforms else PLATFORMS
+        unknown_platforms = [platform for platform in self.platforms if platform not in PLATFORMS]
+        if unknown_platforms:
+            raise ValueError(f'Unknown platforms: {unknown_platforms} (available platforms: {PLATFORMS})')
+        self.failed_platforms = {}
         self.collection_cash_flows = CollectionConnect(database_name='capital_vault', collection_name='cash_flows')
         self.collection_securities_ledger = CollectionConnect(database_name='capital_vault', collection_name='securities_ledger')
         self.collection_cryptos = CollectionConnect(database_name='capital_vault', collection_name='cryptos_ledger')
         self.collection_fixed_income = CollectionConnect(database_name='capital_vault', collection_name='fixed_income_ledger')
+        for collection in self.__ledger_collections():
+            ensure_collection_indexes(collection)
+
+
+    def __ledger_collections(self):
+        ''' Returns the connections to the ledgers collections fed by the platforms data. '''
 
+        return [self.collection_cash_flows, self.collection_securities_ledger, self.collection_cryptos, self.collection_fixed_income]
 
-    def get_collections(self, start_date=None):
+
+    def index_usage(self):
+        ''' Returns the usage statistics of the ledgers collections indexes (see database_schema.index_usage_report). '''
+
+        return index_usage_report(self.__ledger_collections())
+
+
+    def get_collections(self, start_date=None, watermarks=None, executor='thread', max_workers=None):
         '''
         Retrieves and processes data from various platforms.
 
-        Loops over the each platform predefined data extract method by calling the `main()`
-        method to extract the data of each platform. It then returns the processed data as a list of sub_collections.
+        Runs each platform predefined data extract method (`main()`) concurrently in a thread or process pool and
+        filters each platform output as soon as it is available. A failing platform does not stop the others, its
+        error is printed and kept in `failed_platforms`.
+
+        Parameters
+        ----------
+        start_date : pandas.Timestamp, optional
+            If specified, only the rows dated on or after start_date are kept.
+        watermarks : IngestionWatermarks, optional
+            If specified, each platform only emits the records dated on or after its resume dates (per destination collection).
+        executor : str, optional
+            'thread' (default, suited to the API / IO bound extracts) or 'process' (suited to the CPU bound file parsing).
+        max_workers : int, optional
+            Maximum number of concurrent extracts, one per platform if not specified.
 
         Returns
         -------
         collection_list : list
-            A list of dictionaries, where each dictionary contains the data and metadata for a specific collection.
+            A list of dictionaries, where each dictionary contains the data and metadata for a specific collection
+            (and the platform it comes from).
         '''
 
+        self.failed_platforms = {}
+        platform_collections = {}
+        with EXECUTORS[executor](max_workers=max_workers or len(self.platforms)) as pool:
+            futures = {pool.submit(extract_platform, platform, watermarks.platform_since(platform) if watermarks else None): platform
+                       for platform in self.platforms}
+            for future in as_completed(futures):
+                platform = futures[future]
+                try:
+                    collection = future.result()
+                except Exception as error:
+                    self.failed_platforms[platform] = error
+                    print(f'\033[1;31mERROR - {platform} data extract failed: {error!r}\033[0m')
+                    continue
+
+                platform_collections[platform] = self.__filter_collection(platform, collection, start_date, watermarks)
+
         collection_list = []
-        for platform in self.platforms:
-            collection = PLATFORMS_MODULES[platform].main()
+        for platform in self.platforms: # keeps the platforms order whatever the completion order
+            collection_list += platform_collections.get(platform, [])
+        return collection_list
 
-            if start_date:
-                for idx in range(len(collection)):
-                    df = collection[idx]['DataFrame']
-                    df['date'] = pd.to_datetime(df['date'], utc=True)
-                    collection[idx]['DataFrame'] = df.loc[df['date'] >= start_date]
 
-            collection = list(filter(lambda x: x['DataFrame'].empty==False, collection))
-            collection_list += collection
-        return collection_list
+    @staticmethod
+    def __filter_collection(platform, collection, start_date=None, watermarks=None):
+        ''' Tags the collection configs of a platform extract with the platform, keeps the rows dated on or after
+        start_date and on or after the destination resume date, and drops the empty configs. '''
+
+        for idx in range(len(collection)):
+            collection[idx]['platform'] = platform
+            resume_date = watermarks.resume_date(platform, collection[idx]['destination_collection']) if watermarks else None
+            if start_date or resume_date is not None:
+                df = collection[idx]['DataFrame']
+                df['date'] = pd.to_datetime(df['date'], utc=True)
+                if start_date:
+                    df = df.loc[df['date'] >= start_date]
+                if resume_date is not None:
+                    df = df.loc[df['date'] >= resume_date]
+                collection[idx]['DataFrame'] = df
+        return list(filter(lambda x: x['DataFrame'].empty==False, collection))
+
 
+    @staticmethod
+    def __hold_back_last_date(key, collection, pending):
+        ''' Prepends the rows held back from the previous chunk of the same stream and holds back the rows sharing the
+        last date of the chunk (a later chunk can still have rows at that date, they must be sorted together).
 
-    def write_collection(self, collection):
+        Returns the collection config with the rows that can be written (None if there is none).
+        '''
+
+        df = collection['DataFrame']
+        held_back = pending.pop(key, None)
+        if held_back is not None:
+            held_date = pd.to_datetime(held_back['DataFrame']['date'], utc=True).max()
+            if pd.to_datetime(df['date'], utc=True).min() < held_date:
+                raise ValueError(f'{key[0]} chunks are not in chronological order for {key[1]} '
+                                 f'(chunk starting before {held_date}), the balances and _id would differ from a full refresh')
+            df = pd.concat([held_back['DataFrame'], df], ignore_index=True)
+
+        dates = pd.to_datetime(df['date'], utc=True)
+        last_date_mask = (dates == dates.max()).to_numpy()
+        pending[key] = dict(collection, DataFrame=df.loc[last_date_mask])
+        if last_date_mask.all():
+            return None
+        return dict(collection, DataFrame=df.loc[~last_date_mask])
+
+
+    def stream_collections(self, start_date=None, watermarks=None, max_workers=None, max_pending_chunks=4):
+        '''
+        Streaming version of get_collections, yields the collections chunk by chunk as the platforms produce them.
+
+        Each platform stream (see stream_platform) runs in a thread and puts its chunks into a bounded queue, so that
+        at most max_pending_chunks chunks are extracted ahead of the writes, instead of every platform full history.
+        The configs of a chunk going to the same destination are merged, and the rows sharing the last date of a
+        chunk are held back until the next chunk of the same stream (or its end), so that balance_calc can carry its
+        running balances across the chunks and give the same _id as a full refresh. A failing platform stops
+        streaming, its held back rows are dropped and its error is kept in `failed_platforms`.
+
+        Parameters
+        ----------
+        start_date : pandas.Timestamp, optional
+            If specified, only the rows dated on or after start_date are kept.
+        watermarks : IngestionWatermarks, optional
+            If specified, each platform only emits the records dated on or after its resume dates (per destination collection).
+        max_workers : int, optional
+            Maximum number of concurrent platform streams, one per platform if not specified.
+        max_pending_chunks : int, optional
+            Maximum number of extracted chunks waiting to be written (default is 4).
+
+        Yields
+        ------
+        dict
+            Collection config (data, metadata and platform) ready to be written.
+        '''
+
+        self.failed_platforms = {}
+        chunks = queue.Queue(maxsize=max_pending_chunks)
+        stop = threading.Event()
+        end_of_stream = object()
+
+        def produce(platform):
+            since = watermarks.platform_since(platform) if watermarks else None
+            try:
+                for chunk in stream_platform(platform, since):
+                    if not _put_until_stopped(chunks, (platform, chunk), stop):
+                        return
+            except Exception as error:
+                _put_until_stopped(chunks, (platform, error), stop)
+            _put_until_stopped(chunks, (platform, end_of_stream), stop)
+
+        pending = {} # rows held back per (platform, destination, amount column, currency column)
+        pool = ThreadPoolExecutor(max_workers=max_workers or len(self.platforms))
+        try:
+            for platform in self.platforms:
+                pool.submit(produce, platform)
+
+            running_streams = len(self.platforms)
+            while running_streams:
+                platform, chunk = chunks.get()
+                platform_keys = [key for key in pending if key[0] == platform]
+                if chunk is end_of_stream:
+                    running_streams -= 1
+                    for key in platform_keys:
+                        yield pending.pop(key)
+                elif isinstance(chunk, Exception):
+                    for key in platform_keys:
+                        del pending[key]
+                    self.failed_platforms[platform] = chunk
+                    print(f'\033[1;31mERROR - {platform} data extract failed: {chunk!r}\033[0m')
+                else:
+                    merged_chunk = merge_collections(self.__filter_collection(platform, chunk, start_date, watermarks))
+                    for key, collection in merged_chunk.items():
+                        ready_collection = self.__hold_back_last_date(key, collection, pending)
+                        if ready_collection is not None:
+                            yield ready_collection
+        finally:
+            stop.set()
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+    def write_collection(self, collection, balances=None):
         ''' Cleans the data and writes it to the appropriate MongoDB collection.
 
         Parameters
@@ -120,32 +441,114 @@ class CapitalVaultDataFeed:
         collection : dict
             A dictionary containing the data frame, amount column name, currency column name,
             and the target collection name to which the cleaned data will be written.
+        balances : dict, optional
+            Running balances per category, used as opening balances and updated in place (see balance_calc).
+
+        Returns
+        -------
+        dict
+            Number of documents inserted, modified or left unchanged by the bulk write.
         '''
 
-        clean_df = balance_calc(collection['DataFrame'], collection['amount_col'], collection['ccy_col'])
+        clean_df = balance_calc(collection['DataFrame'], collection['amount_col'], collection['ccy_col'], balances)
         collection = getattr(self, collection['destination_collection'], None)
-        collection.collection_writer(clean_df, id_column_name='_id')
+        report = collection.collection_writer(clean_df, id_column_name='_id')
+        ensure_collection_indexes(collection) # indexes of the fields stored by the first write (SQLite backend)
+        return report
 
 
-    def data_feed(self, update=False):
+    def data_feed(self, update=False, executor='thread', stream=False):
         ''' Orchestrates the entire data feed process.
 
+        A full refresh writes each destination of each platform at once, the balances are then computed with a single
+        groupby cumsum and the ingestion watermarks are left untouched. The incremental updates and the streaming mode
+        carry the running balances from write to write and move the watermarks after each write: the next incremental
+        update processes the records again from the start of the day of the last record written (the day-dated sources
+        can add records to that day in a later export), the stored records of the platform from that day are deleted
+        and the running balances are rewound to the start of that day, so that the records get the same _id as in a
+        full refresh. A platform destination without watermark is written again in full (its stored records are
+        deleted first). In streaming mode, each chunk is written (and the watermark moved) as soon as it is extracted,
+        an interrupted refresh is then resumed by the next incremental update.
+
         Parameters
         ----------
         update : bool, optional
-            If True, performs an incremental update by processing data starting from
-            the first day of the current year. If False, processes all available data
+            If True, performs an incremental update by processing only the data from the ingestion watermarks resume
+            dates (full history for a platform without watermark). If False, processes all available data
             (default is False).
+        executor : str, optional
+            Pool used to run the platforms extracts concurrently, 'thread' or 'process' (default is 'thread'),
+            the streaming mode always uses threads.
+        stream : bool, optional
+            If True, the platforms data is extracted and written chunk by chunk (see stream_collections) rather than
+            extracted in full before the first write (default is False).
 
         '''
 
-        start_date = None
-        if update:
-            start_date = pd.to_datetime(f'{pd.Timestamp.now().year}-01-01', utc=True)
-        collection_list = self.get_collections(start_date)
+        watermarks = IngestionWatermarks() if update or stream else None
+        if stream:
+            collection_list = self.stream_collections(watermarks=watermarks if update else None)
+        else:
+            # one write per destination, so that each watermark covers the records of every config of the destination
+            collection_list = merge_collections(self.get_collections(watermarks=watermarks if update else None, executor=executor)).values()
+        states = {}
         for sub_collection in collection_list:
-            self.write_collection(sub_collection)
+            if watermarks is None:
+                report = self.write_collection(sub_collection)
+            else:
+                report = self.__write_resumable(sub_collection, watermarks, update, states)
+            print(f"\033[1;32m{sub_collection['destination_collection']} write:\033[37m\033[3m {report['inserted']} inserted, "
+                  f"{report['modified']} modified, {report['unchanged']} unchanged.\033[0m")
+
+
+    def __write_resumable(self, sub_collection, watermarks, update, states):
+        ''' Writes a collection config continuing the running balances of its (platform, destination) and moves its
+        watermark (see data_feed).
+
+        Parameters
+        ----------
+        sub_collection : dict
+            Collection config to be written.
+        watermarks : IngestionWatermarks
+            Ingestion watermarks, updated after the write.
+        update : bool
+            True for an incremental update (the first write of a destination resumes from its watermark, or replaces
+            every stored record of the platform without watermark), False for a streamed full refresh.
+        states : dict
+            Write state per (platform, destination), updated in place: running balances, number of records written,
+            start of the day of the last record and the balances and number of records at that time.
+
+        Returns
+        -------
+        dict
+            Write report of write_collection.
+        '''
 
+        df = sub_collection['DataFrame']
+        watermark_key = (sub_collection['platform'], sub_collection['destination_collection'])
+        if watermark_key not in states:
+            resume_date = watermarks.resume_date(*watermark_key) if update else None
+            balances = watermarks.resume_balances(*watermark_key) if update else {}
+            rows = watermarks.resume_rows(*watermark_key) if update else 0
+            if update: # the records from resume_date (every record without watermark) are written again, with the rewound balances
+                deleted = getattr(self, watermark_key[1]).document_delete(date_range=(resume_date, None), equals={'platform': df['platform'].dropna().unique().tolist()})
+                rows = watermarks.rows(*watermark_key) - deleted if rows is None else rows
+            states[watermark_key] = {'balances': balances, 'rows': rows, 'day_start': resume_date, 'day_balances': balances, 'day_rows': rows}
+        state = states[watermark_key]
+
+        opening_balances = {category: list(balance) for category, balance in state['balances'].items()}
+        report = self.write_collection(sub_collection, state['balances'])
+
+        dates = pd.to_datetime(df['date'], utc=True)
+        last_date = dates.max()
+        last_day = last_date.normalize()
+        if state['day_start'] != last_day or (dates < last_day).any():
+            state['day_balances'] = day_opening_balances(df, last_day, sub_collection['amount_col'], sub_collection['ccy_col'], opening_balances)
+            state['day_start'], state['day_rows'] = last_day, state['rows'] + int((dates < last_day).sum())
+        state['rows'] += len(df)
+        watermarks.update(*watermark_key, last_date=last_date, balances=state['balances'], rows=state['rows'],
+                          resume_balances=state['day_balances'], resume_rows=state['day_rows'])
+        return report
 
 
 
@@ -1,8 +1,9 @@
 import os
 import pandas as pd
 
-from datetime import datetime
 from src.plutus_lens.data import collection_config
+from src.plutus_lens.data.platform_data._data_extract_util import filter_since, parse_dates, read_csv_directory
+from src.plutus_lens.data.platform_data._parse_cache import cached_read
 
 
 
@@ -15,6 +16,10 @@ DATA_PATHS = {
     'previous_account':f'{STATEMENT_PATH_ROOT}/transactions_history.csv',
     'money_market':f'{STATEMENT_PATH_ROOT}/saving_data/',
 }
+ACCOUNT_STATEMENT_DTYPES = {'Type': 'str', 'Completed Date': 'str', 'Description': 'str', 'Amount': 'float64', 'Fee': 'float64',
+                            'Currency': 'str', 'Balance': 'float64', 'State': 'str'}
+CRYPTOS_DTYPES = {'Date': 'str', 'Symbol': 'str', 'Type': 'str', 'Quantity': 'str', 'Price': 'str', 'Value': 'str', 'Fees': 'str'}
+MONEY_MARKET_DTYPES = {'Date': 'str', 'Description': 'str', 'Value': 'str'}
 
 
 
@@ -28,14 +33,10 @@ def clean_account_statement(path_current_account, path_previous_account):
 
     '''
 
-    account_statements_list = os.listdir(path_current_account)
-    account_statements_list_filtered = list(filter(lambda x: '.csv' in x, account_statements_list))
-    account_statements_files = [pd.read_csv(path_current_account + file)[['Type', 'Completed Date', 'Description', 'Amount', 'Fee', 'Currency', 'Balance', 'State']] for file in account_statements_list_filtered]
-
-    df = pd.concat(account_statements_files, ignore_index=True)
+    df = read_csv_directory(path_current_account, ACCOUNT_STATEMENT_DTYPES)[list(ACCOUNT_STATEMENT_DTYPES)]
     df = df.loc[df['State'] == 'COMPLETED']
     df['Amount'] -= df['Fee']
-    df1 = pd.read_csv(path_previous_account)
+    df1 = cached_read(path_previous_account, pd.read_csv)
     df1 = df1.loc[df1['State'] == 'Completed'][df.columns]
     df1['Amount'] += df1['Fee']
     merged_df = pd.concat([df, df1], ignore_index=True)
@@ -44,14 +45,6 @@ def clean_account_statement(path_current_account, path_previous_account):
 
 
 
-def convert_english_months(df_col):
-    month_translation = {'janv.': 'Jan', 'févr.': 'Feb', 'mars': 'Mar', 'avr.': 'Apr', 'mai': 'May', 'juin': 'Jun',
-    'juil.': 'Jul', 'août': 'Aug', 'sept.': 'Sep', 'oct.': 'Oct', 'nov.': 'Nov', 'déc.': 'Dec'}
-    for fr, en in month_translation.items():
-        df_col = df_col.str.replace(fr, en)
-    return df_col
-
-
 def cash_flow_prep(path_current_account, path_previous_account):
     ''' Extract the cash flows positions from account activity data and returns a cleaned df.
 
@@ -90,14 +83,9 @@ def __add_transfer_fees(crypto_ledger):
 def cryptos_prep(path_cryptos):
     ''' Extract the cryptos transactions from the dedicated csv, returns a cleaned df and feeds it into the MongoDB database. '''
 
-    crypto_ledger_list = os.listdir(path_cryptos)
-    crypto_ledger_list_filtered = list(filter(lambda x: '.csv' in x, crypto_ledger_list))
-    crypto_ledger_list_files = [pd.read_csv(path_cryptos + file) for file in crypto_ledger_list_filtered]
-
-    crypto_ledger = pd.concat(crypto_ledger_list_files, ignore_index=True)
+    crypto_ledger = read_csv_directory(path_cryptos, CRYPTOS_DTYPES)
     # crypto_ledger = pd.read_csv(path_cryptos)
-    crypto_ledger['Date'] = convert_english_months(crypto_ledger['Date'])
-    crypto_ledger['Date'] = crypto_ledger['Date'].apply(lambda x: datetime.strptime(x, '%d %b %Y, %H:%M:%S'))
+    crypto_ledger['Date'] = parse_dates(crypto_ledger['Date'], '%d %b %Y, %H:%M:%S', french_months=True)
     crypto_ledger['currency'] = crypto_ledger['Fees'].str.split(' ', expand=True).iloc[:,-1]
     crypto_ledger[['Quantity', 'Price', 'Value', 'Fees']] = crypto_ledger[['Quantity', 'Price', 'Value', 'Fees']].replace({',':'.', 'CHF':'', ' ':'', ' ':''}, regex=True).astype(float)
     crypto_ledger.rename(columns={'Quantity':'units', 'Value':'amount', 'Fees':'fees', 'Date':'date', 'Symbol':'ticker', 'Type':'type', 'Price':'price'}, inplace=True)
@@ -121,13 +109,8 @@ def cryptos_prep(path_cryptos):
 def money_market_prep(path_money_market):
     ''' Extract the money market funds transactions from the dedicated csv, returns a cleaned df and feeds it into the MongoDB database. '''
 
-    money_market_list = os.listdir(path_money_market)
-    money_market_list_list_filtered = list(filter(lambda x: '.csv' in x, money_market_list))
-    money_market_list_list_files = [pd.read_csv(path_money_market + file) for file in money_market_list_list_filtered]
-
-    money_market_df = pd.concat(money_market_list_list_files, ignore_index=True)
-    money_market_df['Date'] = convert_english_months(money_market_df['Date'])
-    money_market_df['Date'] = money_market_df['Date'].apply(lambda x: datetime.strptime(x, '%d %b %Y, %H:%M:%S'))
+    money_market_df = read_csv_directory(path_money_market, MONEY_MARKET_DTYPES)
+    money_market_df['Date'] = parse_dates(money_market_df['Date'], '%d %b %Y, %H:%M:%S', french_months=True)
 
     currencies = {'£': 'GBP', '€': 'EUR', 'CHF': 'CHF'}
     for ccy, currency_code in currencies.items():
@@ -149,7 +132,7 @@ def money_market_prep(path_money_market):
 
 
 
-def main():
+def main(since=None):
     crypto_ledger = cryptos_prep(DATA_PATHS['cryptos'])
 
     cash_flows = collection_config(
@@ -158,7 +141,7 @@ def main():
     money_market = collection_config(dataframe=money_market_prep(DATA_PATHS['money_market']), collection_name='collection_fixed_income', amount_col='amount')
 
     dfs_list = [cash_flows, cryptos, money_market]
-    return dfs_list
+    return filter_since(dfs_list, since)
 
 
 
@@ -0,0 +1,433 @@
+''' Embedded SQLite storage backend, implementing the CollectionConnect interface of database_studio
+(one SQLite file per database, one table per collection, one column per document field) '''
+
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from .database_schema import LEDGER_COLLECTIONS, apply_ledger_schema
+from .database_studio import HASH_FIELD, build_query_filter, content_hashes
+
+
+SQLITE_DIR = os.environ.get('capital_tracker_sqlite_dir', os.path.join(os.path.expanduser('~'), '.plutus_lens'))
+NAT_INT = np.iinfo(np.int64).min # NaT as stored by numpy in datetime64[ns]
+MAX_VARIABLES = 999 # SQLITE_MAX_VARIABLE_NUMBER of the SQLite builds older than 3.32
+
+_CONNECTIONS = {} # one connection per SQLite file, shared by every connection object
+_CONNECTIONS_LOCK = threading.RLock()
+_SQL_OPERATORS = {'$eq': '=', '$ne': 'IS NOT', '$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+
+
+
+
+def shared_connection(database_path):
+    ''' Returns the sqlite3 connection of the given file, opened on first use and then reused by the whole process. '''
+
+    with _CONNECTIONS_LOCK:
+        if database_path not in _CONNECTIONS:
+            os.makedirs(os.path.dirname(database_path) or '.', exist_ok=True)
+            connection = sqlite3.connect(database_path, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS "_columns" (collection TEXT, name TEXT, kind TEXT, PRIMARY KEY (collection, name))')
+            _CONNECTIONS[database_path] = connection
+        return _CONNECTIONS[database_path]
+
+
+def _quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _column_kind(series):
+    ''' Storage kind of a DataFrame column (datetime, int, float, bool or text). '''
+
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        dtype = dtype.categories.dtype
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return 'datetime'
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'bool'
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'int'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'float'
+
+    sample = next((value for value in series.tolist() if not _is_missing(value)), None)
+    if isinstance(sample, (datetime, np.datetime64)):
+        return 'datetime'
+    if isinstance(sample, (bool, np.bool_)):
+        return 'bool'
+    if isinstance(sample, (int, np.integer)):
+        return 'int'
+    if isinstance(sample, (float, np.floating)):
+        return 'float'
+    return 'text'
+
+
+def _is_missing(value):
+    return value is None or (not isinstance(value, (str, bytes, list, dict, tuple)) and pd.isna(value))
+
+
+def _encode_column(series, kind):
+    ''' Encodes a DataFrame column into python values storable by sqlite3 (datetimes as UTC nanoseconds since epoch). '''
+
+    if kind == 'datetime':
+        stamps = pd.to_datetime(series, utc=True).dt.tz_localize(None).to_numpy('datetime64[ns]')
+        encoded = stamps.view('int64').astype(object)
+        encoded[np.isnat(stamps)] = None
+        return encoded.tolist()
+    if kind == 'text':
+        return [None if _is_missing(value) else str(value) for value in series.tolist()]
+    return [None if _is_missing(value) else value for value in series.tolist()]
+
+
+def _encode_scalar(value, kind):
+    ''' Encodes a filter value the same way as the column it is compared with. '''
+
+    if _is_missing(value):
+        return None
+    if kind == 'datetime':
+        stamp = pd.Timestamp(value)
+        return (stamp.tz_convert('UTC').tz_localize(None) if stamp.tzinfo else stamp).as_unit('ns').value
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _decode_column(values, kind):
+    ''' Decodes the stored values of a column into a typed NumPy array (missing values as NaT / NaN / None). '''
+
+    if kind == 'datetime':
+        return np.array([NAT_INT if value is None else value for value in values], dtype='int64').view('datetime64[ns]')
+    if kind == 'float' or (kind == 'int' and None in values):
+        return np.array(values, dtype='float64')
+    if kind == 'int':
+        return np.array(values, dtype='int64')
+    if kind == 'bool':
+        return np.array([None if value is None else bool(value) for value in values], dtype=object)
+    return np.array(values, dtype=object)
+
+
+
+
+class SQLiteCollectionConnect:
+    ''' Class meant to handle an embedded SQLite collection with the same contract as database_studio.CollectionConnect.
+
+    The database file and the collection table are created on first use (no confirmation prompt, the backend is
+    meant for single-user runs, tests and benchmarks without a MongoDB server).
+
+    Attributes
+    ----------
+    collection_name : str
+        Name of the collection (SQLite table).
+    database_name : str
+        Name of the database (SQLite file <database_name>.sqlite in database_dir).
+    database_dir : str, optional
+        Folder of the SQLite files. The default is SQLITE_DIR (capital_tracker_sqlite_dir environment variable).
+
+    '''
+
+    def __init__(self, collection_name, database_name, database_dir=None, client_address=None):
+        self.database_name = database_name
+        self.collection_name = collection_name
+        self.client_address = os.path.join(database_dir or SQLITE_DIR, f'{database_name}.sqlite')
+        self.connection = shared_connection(self.client_address)
+        with _CONNECTIONS_LOCK, self.connection:
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS {_quote(collection_name)} ("_id" PRIMARY KEY)')
+
+
+    def __column_kinds(self):
+        rows = self.connection.execute('SELECT name, kind FROM "_columns" WHERE collection = ? ORDER BY rowid', (self.collection_name,)).fetchall()
+        return dict(rows)
+
+
+    def __add_columns(self, data):
+        ''' Adds the table columns (and records their storage kind) for the fields of data not stored yet, and checks
+        that the fields already stored keep their kind.
+
+        An int column receiving floats is widened to float, and a column holding only missing values takes the kind of
+        the first actual values. Any other kind change raises a TypeError (the values would be silently coerced).
+        '''
+
+        column_kinds = self.__column_kinds()
+        for column in data.columns:
+            if column in column_kinds:
+                if column == HASH_FIELD or data[column].isna().all():
+                    continue
+                kind = _column_kind(data[column])
+                stored_kind = column_kinds[column]
+                if kind == stored_kind or (stored_kind == 'float' and kind == 'int'):
+                    continue
+                stored_values = self.connection.execute(f'SELECT 1 FROM {_quote(self.collection_name)} WHERE {_quote(column)} IS NOT NULL LIMIT 1').fetchone()
+                if stored_values and not (stored_kind == 'int' and kind == 'float'):
+                    raise TypeError(f'{self.collection_name}.{column} is stored as {stored_kind}, got {kind} values')
+                self.connection.execute('UPDATE "_columns" SET kind = ? WHERE collection = ? AND name = ?', (kind, self.collection_name, column))
+                column_kinds[column] = kind
+                continue
+            kind = _column_kind(data[column])
+            if column != '_id':
+                self.connection.execute(f'ALTER TABLE {_quote(self.collection_name)} ADD COLUMN {_quote(column)}')
+            self.connection.execute('INSERT INTO "_columns" VALUES (?, ?, ?)', (self.collection_name, column, kind))
+            column_kinds[column] = kind
+        return column_kinds
+
+
+    def collection_writer(self, data, id_column_name=False, bulk=True, batch_size=1000, skip_unchanged=True):
+        ''' Includes the element of data into the SQLite collection (upsert on _id, unchanged rows are not rewritten).
+
+        Parameters
+        ----------
+        data : pandas.DataFrame
+            Data to be included in the collection.
+        id_column_name : str
+            Name of the column that should be considered as the _id (unique identifier) of each document.
+        bulk : bool, optional
+            Kept for interface compatibility, rows are always written with batched statements. The default is True.
+        batch_size : int, optional
+            Number of rows sent per statement batch, capped to MAX_VARIABLES (one parameter per _id of the stored hashes
+            lookup). The default is 1000.
+        skip_unchanged : bool, optional
+            If True, stores a content hash with each row and only sends the rows whose hash differs from the stored one.
+            The default is True.
+
+        Returns
+        -------
+        dict
+            Number of documents inserted, modified or left unchanged by the write.
+
+        '''
+
+        hashes = content_hashes(data) if skip_unchanged else None
+        data = data.copy(deep=False)
+        if skip_unchanged:
+            data[HASH_FIELD] = hashes
+        if id_column_name:
+            data['_id'] = data[id_column_name]
+        elif '_id' not in data.columns:
+            data['_id'] = [uuid.uuid4().hex for _ in range(len(data))]
+
+        batch_size = min(batch_size, MAX_VARIABLES)
+        report = {'inserted': 0, 'modified': 0, 'unchanged': 0}
+        with _CONNECTIONS_LOCK, self.connection:
+            column_kinds = self.__add_columns(data)
+            columns = data.columns.tolist()
+            encoded_columns = [_encode_column(data[column], column_kinds[column]) for column in columns]
+            rows = list(zip(*encoded_columns))
+
+            updated_columns = [column for column in columns if column != '_id']
+            table = _quote(self.collection_name)
+            statement = f"INSERT INTO {table} ({', '.join(map(_quote, columns))}) VALUES ({', '.join('?' * len(columns))})"
+            if updated_columns:
+                statement += (f" ON CONFLICT(\"_id\") DO UPDATE SET {', '.join(f'{_quote(column)} = excluded.{_quote(column)}' for column in updated_columns)}"
+                              f" WHERE NOT ({' AND '.join(f'{table}.{_quote(column)} IS excluded.{_quote(column)}' for column in updated_columns)})")
+            else:
+                statement += ' ON CONFLICT("_id") DO NOTHING'
+
+            id_position = columns.index('_id')
+            stored_hash_column = _quote(HASH_FIELD) if HASH_FIELD in column_kinds else 'NULL'
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                batch_ids = [row[id_position] for row in batch]
+                stored_hashes = dict(self.connection.execute(f'SELECT "_id", {stored_hash_column} FROM {table} WHERE "_id" IN ({", ".join("?" * len(batch_ids))})',
+                                                             batch_ids).fetchall())
+                if skip_unchanged:
+                    hash_position = columns.index(HASH_FIELD)
+                    changed_batch = [row for row in batch if row[id_position] not in stored_hashes or stored_hashes[row[id_position]] != row[hash_position]]
+                    report['unchanged'] += len(batch) - len(changed_batch)
+                    batch = changed_batch
+                existing = sum(row[id_position] in stored_hashes for row in batch)
+                changes = self.connection.executemany(statement, batch).rowcount if batch else 0
+                report['inserted'] += len(batch) - existing
+                report['modified'] += changes - (len(batch) - existing)
+                report['unchanged'] += existing - (changes - (len(batch) - existing))
+        return report
+
+
+    def field_updater(self, data, fields, id_column_name='_id', batch_size=1000):
+        ''' Sets some fields of rows already stored (same contract as CollectionConnect.field_updater). '''
+
+        fields = list(fields)
+        data = data.loc[data[fields].notna().any(axis=1), fields].assign(_id=data[id_column_name])
+        report = {'inserted': 0, 'modified': 0, 'unchanged': 0}
+        with _CONNECTIONS_LOCK, self.connection:
+            column_kinds = self.__add_columns(data)
+            rows = list(zip(*[_encode_column(data[column], column_kinds[column]) for column in fields + ['_id']]))
+            table = _quote(self.collection_name)
+            assignments = [f'{_quote(field)} = ?' for field in fields] + ([f'{_quote(HASH_FIELD)} = NULL'] if HASH_FIELD in column_kinds else [])
+            statement = (f"UPDATE {table} SET {', '.join(assignments)} WHERE \"_id\" = ?"
+                         f" AND NOT ({' AND '.join(f'{_quote(field)} IS ?' for field in fields)})")
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                changes = self.connection.executemany(statement, [row + row[:-1] for row in batch]).rowcount
+                report['modified'] += changes
+                report['unchanged'] += len(batch) - changes
+        return report
+
+
+    def ensure_indexes(self, index_specs):
+        ''' Creates the indexes of index_specs that do not exist yet on the collection table.
+
+        Parameters
+        ----------
+        index_specs : list
+            List of index keys, each one being a list of (field, direction) tuples.
+
+        Returns
+        -------
+        created_indexes : list
+            Names of the indexes created by the call.
+        skipped_specs : list
+            Index keys not created because some of their fields are not stored yet (no table column before the first
+            write of the field), to be requested again after a write.
+
+        '''
+
+        created_indexes, skipped_specs = [], []
+        with _CONNECTIONS_LOCK, self.connection:
+            column_kinds = self.__column_kinds()
+            existing = {row[0] for row in self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?", (self.collection_name,))}
+            for keys in index_specs:
+                name = '_'.join(f'{field}_{direction}' for field, direction in keys)
+                if f'{self.collection_name}__{name}' in existing:
+                    continue
+                if any(field not in column_kinds for field, _ in keys):
+                    skipped_specs.append(list(keys))
+                    continue
+                fields = ', '.join(f"{_quote(field)} {'DESC' if direction == -1 else 'ASC'}" for field, direction in keys)
+                self.connection.execute(f'CREATE INDEX {_quote(f"{self.collection_name}__{name}")} ON {_quote(self.collection_name)} ({fields})')
+                created_indexes.append(name)
+        return created_indexes, skipped_specs
+
+
+    def index_usage(self):
+        ''' Returns the indexes of the collection table (SQLite does not count index accesses, accesses and since are left empty).
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per index with its name, keys, number of accesses and the date since when they are counted.
+
+        '''
+
+        usage = []
+        indexes = self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?", (self.collection_name,)).fetchall()
+        for (index_name,) in indexes:
+            keys = [(row[2], -1 if row[3] else 1) for row in self.connection.execute(f'PRAGMA index_xinfo({_quote(index_name)})') if row[5]]
+            name = '_id_' if index_name.startswith('sqlite_autoindex') else index_name.split('__', 1)[-1]
+            usage.append({'name': name, 'key': keys, 'accesses': None, 'since': None})
+        return pd.DataFrame(usage, columns=['name', 'key', 'accesses', 'since'])
+
+
+    def date_bounds(self, date_col='date'):
+        ''' Returns the first and last dates of the collection (same contract as CollectionConnect.date_bounds). '''
+
+        with _CONNECTIONS_LOCK:
+            column_kinds = self.__column_kinds()
+            if date_col not in column_kinds:
+                return pd.NaT, pd.NaT
+            bounds = self.connection.execute(f'SELECT MIN({_quote(date_col)}), MAX({_quote(date_col)}) FROM {_quote(self.collection_name)}').fetchone()
+        return tuple(pd.Timestamp(value) for value in _decode_column(bounds, column_kinds[date_col]))
+
+
+    def distinct_values(self, field):
+        ''' Returns the distinct non-missing values of a field (same contract as CollectionConnect.distinct_values). '''
+
+        with _CONNECTIONS_LOCK:
+            column_kinds = self.__column_kinds()
+            if field not in column_kinds:
+                return []
+            values = self.connection.execute(f'SELECT DISTINCT {_quote(field)} FROM {_quote(self.collection_name)} WHERE {_quote(field)} IS NOT NULL').fetchall()
+        return _decode_column([value for (value,) in values], column_kinds[field]).tolist()
+
+
+    def document_delete(self, query_dict=None, date_range=None, equals=None, date_col='date'):
+        ''' Deletes the rows matching the filters (same contract as CollectionConnect.document_delete). '''
+
+        query_filter = build_query_filter(query_dict, date_range, equals, date_col)
+        with _CONNECTIONS_LOCK, self.connection:
+            where_clause, parameters = _filter_to_sql(query_filter, self.__column_kinds())
+            return self.connection.execute(f'DELETE FROM {_quote(self.collection_name)} WHERE {where_clause}', parameters).rowcount
+
+
+    def document_query(self, query_dict=None, projection=None, date_range=None, equals=None, date_col='date', batch_size=None, columnar=False):
+        ''' Retrieves document(s) from the collection based on the query dict match (same contract as CollectionConnect.document_query).
+
+        The query dict supports field equality, the $eq, $ne, $gt, $gte, $lt, $lte, $in and $nin operators and $and / $or lists.
+        The output is always decoded into typed NumPy columns (columnar is kept for interface compatibility).
+
+        Returns
+        -------
+        pandas.DataFrame
+            Query output (elements of the collection for which the filters match.
+
+        '''
+
+        query_filter = build_query_filter(query_dict, date_range, equals, date_col)
+        with _CONNECTIONS_LOCK:
+            column_kinds = self.__column_kinds()
+            default_columns = ['_id'] + [column for column in column_kinds if column not in ('_id', HASH_FIELD)]
+            columns = [column for column in (projection or default_columns) if column in column_kinds]
+            if not columns:
+                return pd.DataFrame()
+            where_clause, parameters = _filter_to_sql(query_filter, column_kinds)
+            cursor = self.connection.execute(f"SELECT {', '.join(map(_quote, columns))} FROM {_quote(self.collection_name)} WHERE {where_clause}", parameters)
+            rows = []
+            while batch := cursor.fetchmany(batch_size or 10000):
+                rows += batch
+
+        if not rows:
+            query_df = pd.DataFrame(columns=columns)
+        else:
+            query_df = pd.DataFrame({column: _decode_column(values, column_kinds[column]) for column, values in zip(columns, zip(*rows))})
+        return apply_ledger_schema(query_df) if self.collection_name in LEDGER_COLLECTIONS else query_df
+
+
+
+
+def _filter_to_sql(query_filter, column_kinds):
+    ''' Translates a MongoDB filter into a SQL where clause and its parameters.
+
+    Parameters
+    ----------
+    query_filter : dict
+        MongoDB filter (field equality, comparison operators, $in / $nin, $and / $or).
+    column_kinds : dict
+        Storage kind of each stored column, used to encode the compared values.
+
+    Returns
+    -------
+    tuple
+        (where clause, list of parameters).
+
+    '''
+
+    clauses, parameters = [], []
+    for field, condition in query_filter.items():
+        if field in ('$and', '$or'):
+            sub_clauses = [_filter_to_sql(sub_filter, column_kinds) for sub_filter in condition]
+            clauses.append('(' + f" {field[1:].upper()} ".join(clause for clause, _ in sub_clauses) + ')')
+            parameters += [parameter for _, sub_parameters in sub_clauses for parameter in sub_parameters]
+            continue
+
+        kind = column_kinds.get(field)
+        column = _quote(field) if kind else 'NULL'
+        operations = condition if isinstance(condition, dict) and all(str(key).startswith('$') for key in condition) else {'$eq': condition}
+        for operator, value in operations.items():
+            if operator in ('$in', '$nin'):
+                values = [_encode_scalar(item, kind) for item in value]
+                clauses.append(f"{column} {'NOT IN' if operator == '$nin' else 'IN'} ({', '.join('?' * len(values))})")
+                parameters += values
+            elif operator in _SQL_OPERATORS:
+                sql_operator = _SQL_OPERATORS[operator]
+                if operator == '$eq':
+                    sql_operator = 'IS'
+                clauses.append(f'{column} {sql_operator} ?')
+                parameters.append(_encode_scalar(value, kind))
+            else:
+                raise ValueError(f'Unsupported query operator for the SQLite backend: {operator}')
+    return (' AND '.join(clauses) if clauses else '1'), parameters
@@ -25,7 +25,7 @@ class CollectionService:
         self.fx_data = ForexData().clean_fx_data()
         self.unit_of_account_col_name = unit_of_account_col_name
         self.ticker_col_name = ticker_col_name
-        self.cash_flows_data = CollectionConnect(database_name='capital_vault', collection_name='cash_flows').document_query({})
+        self.cash_flows_data = CollectionConnect(database_name='capital_vault', collection_name='cash_flows').document_query(projection=['date'])
         self._date_range = pd.date_range(start=self.cash_flows_data['date'].min().normalize(), end=self.cash_flows_data['date'].max().normalize())
         self.clean_data = self.__clean_main_data()
 
@@ -38,7 +38,7 @@ class CollectionService:
             ticker, platform, and unit of account data.
         '''
 
-        data = self.main_collection.document_query({})
+        data = self.main_collection.document_query(projection=['date', self.unit_of_account_col_name, self.ticker_col_name, 'asset_class', 'platform'])
         data['date_only'] = data['date'].dt.normalize()
         clean_df = data[['date', 'date_only', self.unit_of_account_col_name, self.ticker_col_name, 'asset_class', 'platform']]
         return clean_df
@@ -55,11 +55,12 @@ class CollectionService:
             The index represents the date range, and columns represent accounts (platform + ticker).
         '''
 
-        balance_df = self.clean_data.copy(deep=True)
-        balance_df['account'] = balance_df['platform'] + ' - ' + balance_df[self.ticker_col_name]
-        balance_df.sort_values(by=['account', 'date'], inplace=True)
-        balance_df['daily_balance'] = balance_df.groupby(['account'])[self.unit_of_account_col_name].cumsum()
-        balances_units = balance_df.pivot_table(index='date_only', columns='account', values='daily_balance', aggfunc='last').reindex(self._date_range).ffill()
+        account_cols = ['platform', self.ticker_col_name] # categorical columns, grouped by code instead of by '{platform} - {ticker}' strings
+        balance_df = self.clean_data.sort_values(by='date', kind='stable')
+        balance_df['daily_balance'] = balance_df.groupby(account_cols, observed=True)[self.unit_of_account_col_name].cumsum()
+        balances_units = balance_df.pivot_table(index='date_only', columns=account_cols, values='daily_balance', aggfunc='last', observed=True)
+        balances_units.columns = [f'{platform} - {ticker}' for platform, ticker in balances_units.columns]
+        balances_units = balances_units.sort_index(axis=1).reindex(self._date_range).ffill()
         return balances_units.fillna(0)
 
 
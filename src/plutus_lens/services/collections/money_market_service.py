@@ -15,7 +15,7 @@ class MoneyMarketService(CollectionService):
 
     def __init__(self):
         super().__init__(main_collection_name='fixed_income_ledger', unit_of_account_col_name='amount', ticker_col_name='isin')
-        self.fx_dict = dict(self.main_collection.document_query({})[['isin', 'currency']].drop_duplicates().values)
+        self.fx_dict = dict(self.main_collection.document_query(projection=['isin', 'currency'])[['isin', 'currency']].drop_duplicates().values)
 
 
     def balance_by_platform_and_asset(self, units_output=False):
@@ -59,7 +59,7 @@ class MoneyMarketService(CollectionService):
         prices_matrix = pd.DataFrame(columns=tickers, index=self._date_range, data=1).fillna(0)
         balances_local_ccy = balance_units * prices_matrix.values
 
-        tickers_ccy_df = self.main_collection.document_query({})[['isin', 'currency']].drop_duplicates()
+        tickers_ccy_df = self.main_collection.document_query(projection=['isin', 'currency'])[['isin', 'currency']].drop_duplicates()
         ticker_to_currency = tickers_ccy_df.set_index('isin')['currency'].to_dict()
         currencies_list = [ticker_to_currency.get(ticker, 'Unknown') for ticker in tickers]
         balances_local_ccy.columns = currencies_list
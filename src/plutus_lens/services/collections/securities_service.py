@@ -42,7 +42,7 @@ class SecuritiesService(CollectionService):
         prices_matrix = pd.DataFrame(columns=tickers, index=self._date_range, data=self.prices_data).fillna(0)
         balances_local_ccy = balance_units * prices_matrix.values
 
-        tickers_ccy_df = self.main_collection.document_query({})[['ticker', 'quote_currency']].drop_duplicates()
+        tickers_ccy_df = self.main_collection.document_query(projection=['ticker', 'quote_currency'])[['ticker', 'quote_currency']].drop_duplicates()
         ticker_to_currency = tickers_ccy_df.set_index('ticker')['quote_currency'].to_dict()
         currencies_list = [ticker_to_currency.get(ticker, 'Unknown') for ticker in tickers]
         fx_matrix = pd.DataFrame(columns=currencies_list, index=self._date_range, data=self.fx_data)
@@ -67,7 +67,7 @@ class SecuritiesService(CollectionService):
         prices_matrix = pd.DataFrame(columns=tickers, index=self._date_range, data=self.prices_data).fillna(0)
         balances_local_ccy = balance_units * prices_matrix.values
 
-        tickers_ccy_df = self.main_collection.document_query({})[['ticker', 'quote_currency']].drop_duplicates()
+        tickers_ccy_df = self.main_collection.document_query(projection=['ticker', 'quote_currency'])[['ticker', 'quote_currency']].drop_duplicates()
         ticker_to_currency = tickers_ccy_df.set_index('ticker')['quote_currency'].to_dict()
         currencies_list = [ticker_to_currency.get(ticker, 'Unknown') for ticker in tickers]
         balances_local_ccy.columns = currencies_list